@@ -0,0 +1,217 @@
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import chatbot
+from chatbot import Chat
+from chatbot.template_cache import TemplateCache
+from chatbot.version import __version__
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SIZES = (10, 1000, 50000)
+GROUP_SIZE = 50
+KINDS = ("hit", "miss", "typo")
+PERCENTILES = (50, 90, 99)
+UNKNOWN = "I don't know"
+DEFAULT_TEMPLATE = "{%% response %%}%s{%% endresponse %%}\n" % UNKNOWN
+
+
+def synthetic_template(blocks):
+    """
+    Template of `blocks` blocks, mixing plain and captured responses, conditions on memory,
+    learn blocks and topics made of nested groups.
+    """
+    top, groups = [], []
+    for i in range(blocks):
+        kind = i % 5
+        if kind == 0:
+            block = ("what is item%d" % i, "item%d is fine" % i)
+        elif kind == 1:
+            block = ("tell me about thing%d (.*)" % i, "thing%d and %%1" % i)
+        elif kind == 2:
+            block = ("do you like fruit%d" % i,
+                     "{%% if {liked%d} == yes %%}still yes{%% else %%}{!liked%d:yes}now yes{%% endif %%}" % (i, i))
+        elif kind == 3:
+            block = ("remember code%d (\\w+)" % i, "ok code%d" % i, _block("who is %1", "%%1 is code%d" % i))
+        else:
+            groups.append(("question%d" % i, "answer%d" % i))
+            continue
+        top.append(block)
+    lines = []
+    for start in range(0, len(groups), GROUP_SIZE):
+        name = "topic%d" % (start // GROUP_SIZE)
+        top.append(("enter %s" % name, "{%% topic %s.inner %%}entered" % name))
+        middle = start + GROUP_SIZE // 2
+        lines.append("{%% group %s %%}" % name)
+        lines.extend(_block(client, response) for client, response in groups[start:middle])
+        lines.append("{% group inner %}")
+        lines.extend(_block(client, response) for client, response in groups[middle:start + GROUP_SIZE])
+        lines.append("{% endgroup %}")
+        lines.append("{% endgroup %}")
+    lines.extend(_block(*block) for block in top)
+    return "\n".join(lines)
+
+
+def _block(client, response, learn=None):
+    learn = "" if learn is None else "{%% learn %%}%s{%% endlearn %%}" % learn
+    return "{%% block %%}{%% client %%}%s{%% endclient %%}{%% response %%}%s{%% endresponse %%}%s{%% endblock %%}" % (
+        client, response, learn)
+
+
+def messages(blocks, count, seed=0):
+    """
+    :return: {kind: [message, ...]} with messages matching a block (hit), matching none (miss)
+        and matching one once spell corrected (typo)
+    """
+    rnd = random.Random(seed)
+    plain = [i for i in range(blocks) if i % 5 in (0, 1, 2)]
+    hits, typos, misses = [], [], []
+    for _ in range(count):
+        i = rnd.choice(plain)
+        hit = ("what is item%d", "tell me about thing%d today", "do you like fruit%d")[i % 5] % i
+        hits.append(hit)
+        typos.append(hit.replace("what", "waht").replace("about", "abuot").replace("like", "lika"))
+        misses.append("zebra %d quantum saxophone %d" % (rnd.randrange(1000), rnd.randrange(1000)))
+    return {"hit": hits, "miss": misses, "typo": typos}
+
+
+def vocabulary(template):
+    """
+    :return: text of the client patterns of the template, the words the spell checker corrects typos into
+    """
+    return "\n".join(re.findall(r"{% client %}(.*?){% endclient %}", template))
+
+
+def local_path(directory, template):
+    """
+    Local directory whose `en` language has the words of the template, the substitutions of the library
+    and a default template answering nothing (the one of the library answers anything, messages would
+    never miss nor be spell corrected).
+    """
+    local = os.path.join(directory, "local")
+    os.makedirs(os.path.join(local, "en"))
+    with open(os.path.join(local, "en", "words.txt"), "w", encoding="utf-8") as words:
+        words.write(vocabulary(template))
+    with open(os.path.join(local, "en", "default.template"), "w", encoding="utf-8") as default_template:
+        default_template.write(DEFAULT_TEMPLATE)
+    shutil.copy(os.path.join(os.path.dirname(chatbot.__file__), "local", "en", "substitutions.json"),
+                os.path.join(local, "en"))
+    return local
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in MB, None where it can't be measured
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentiles(durations):
+    durations = sorted(durations)
+    result = {"mean_us": sum(durations) / len(durations) * 1e6}
+    for percentile in PERCENTILES:
+        index = min(len(durations) - 1, int(round(percentile / 100 * (len(durations) - 1))))
+        result["p%d_us" % percentile] = durations[index] * 1e6
+    return result
+
+
+def run(blocks, count):
+    """
+    Benchmark one template size, in a process of its own so that its peak memory is its own.
+    """
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, "synthetic.template")
+    template = synthetic_template(blocks)
+    with open(file_name, "w", encoding="utf-8") as output:
+        output.write(template)
+    local = local_path(directory, template)
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    chat = Chat(file_name, resources=None, template_cache=None, local_path=local)
+    result = {"blocks": blocks, "init_s": time.perf_counter() - start}
+    cache = TemplateCache(directory)
+    Chat(file_name, resources=None, template_cache=cache, local_path=local)
+    start = time.perf_counter()
+    Chat(file_name, resources=None, template_cache=cache, local_path=local)
+    result["init_cached_s"] = time.perf_counter() - start
+    for kind, texts in messages(blocks, count).items():
+        chat.start_new_session(kind)
+        durations = []
+        answered = 0
+        for text in texts:
+            start = time.perf_counter()
+            reply = chat.say(text, session_id=kind)
+            durations.append(time.perf_counter() - start)
+            answered += reply != UNKNOWN
+        result[kind] = percentiles(durations)
+        result[kind]["answered"] = answered / len(texts)
+    # typos only match once corrected, otherwise the typo timings measure misses
+    assert result["typo"]["answered"] > 0, "no typo was spell corrected"
+    rss = peak_rss()
+    result["peak_rss_mb"] = rss
+    result["chat_rss_mb"] = None if rss is None else rss - rss_before
+    return result
+
+
+def compare(results, previous):
+    """
+    Print how much slower (> 1) or faster (< 1) every measure got since `previous`.
+    """
+    old = {entry["blocks"]: entry for entry in previous["results"]}
+    print("compared to %s" % previous["version"])
+    for entry in results["results"]:
+        if entry["blocks"] not in old:
+            continue
+        before = old[entry["blocks"]]
+        ratios = ["init %.2fx" % (entry["init_s"] / before["init_s"])]
+        ratios.extend("%s p50 %.2fx" % (kind, entry[kind]["p50_us"] / before[kind]["p50_us"]) for kind in KINDS)
+        if entry["peak_rss_mb"] and before["peak_rss_mb"]:
+            ratios.append("rss %.2fx" % (entry["peak_rss_mb"] / before["peak_rss_mb"]))
+        print("%8d blocks: %s" % (entry["blocks"], ", ".join(ratios)))
+
+
+def main(args=None):
+    parser = ArgumentParser(prog="python -m benchmarks.pipeline",
+                            description="Time Chat creation and say() on synthetic templates")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="blocks of the generated templates")
+    parser.add_argument("--messages", type=int, default=300, help="messages said per kind (hit, miss, typo)")
+    parser.add_argument("--output", help="json file the results are written to")
+    parser.add_argument("--compare", help="json file written by a previous run")
+    args = parser.parse_args(args)
+    results = {"version": __version__, "python": platform.python_version(), "platform": platform.platform(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "messages": args.messages, "results": []}
+    print("%8s %9s %9s %s %9s" % ("blocks", "init", "cached", " ".join(
+        "%9s" % ("%s p%d" % (kind, percentile)) for kind in KINDS for percentile in (50, 99)), "peak rss"))
+    for blocks in args.sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            entry = executor.submit(run, blocks, args.messages).result()
+        results["results"].append(entry)
+        print("%8d %8.3fs %8.3fs %s %7.1fMB" % (blocks, entry["init_s"], entry["init_cached_s"], " ".join(
+            "%7.0fus" % entry[kind]["p%d_us" % percentile] for kind in KINDS for percentile in (50, 99)),
+            entry["peak_rss_mb"] or 0))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as previous:
+            compare(results, json.load(previous))
+    return results
+
+
+if __name__ == '__main__':
+    main()
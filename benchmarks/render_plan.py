@@ -0,0 +1,214 @@
+import re
+import timeit
+from urllib.parse import quote
+from chatbot import Chat, mapper
+from chatbot.render import RE_NAMED_GROUP, RE_NAMED_GROUP_SILENT, RE_NUMBERED_GROUP, RE_NUMBERED_GROUP_SILENT
+
+RESPONSES = [
+    "Why do you think %1?",
+    "%name, you said %2 {% if %1 == yes %}and you meant it{% else %}but not really{% endif %}.",
+    "{{fruit:%1}}{% if {{fruit}} != apple %}{% up %1 %} is not an apple{% elif %2 > 3 %}many{% endif %}",
+    "{% cap %name %} likes {{fruit}} \\{not a tag\\}, {% low %2 %} and {{!seen:yes}}%other",
+]
+
+
+class TreeWalk:
+    """
+    The renderer as it was before responses were compiled into render plans: every reply walks the
+    condition tree of the response, slicing and rescanning its text. Only the tags used by RESPONSES
+    (memory, if and the case changes) are kept.
+    """
+
+    def __init__(self, chat):
+        self.chat = chat
+        self._reflections = chat._reflections
+        keys = sorted(self._reflections, key=len, reverse=True)
+        self._regex = re.compile(r"\b({0})\b".format("|".join(map(re.escape, keys))), re.IGNORECASE)
+        self.__action_handlers = {"low": self.__low_handler, "up": self.__up_handler, "cap": self.__cap_handler,
+                                  "map": self.__map_handler}
+
+    def _substitute(self, session, text):
+        if not session.attr.get("substitute", True):
+            return text
+        return self._regex.sub(lambda mo: self._reflections[mo.string[mo.start():mo.end()]], text.lower())
+
+    def __if_handler(self, session, i, condition, response):
+        start = self.__get_start_pos(condition[i]["start"], response, "if")
+        end = condition[i]["end"]
+        check = True
+        matched_index = None
+        _quote = session.attr["_quote"]
+        session.attr["_quote"] = False
+        substitute = session.attr.get("substitute", True)
+        session.attr["substitute"] = False
+        while check:
+            con = self._check_and_evaluate_condition(session, response, condition[i]["child"], start, end)
+            i += 1
+            if self.chat._check_if(session, con):
+                matched_index = i - 1
+                while condition[i]["action"] != "endif":
+                    i += 1
+                check = False
+            elif condition[i]["action"] == "else":
+                matched_index = i
+                while condition[i]["action"] != "endif":
+                    i += 1
+                check = False
+            elif condition[i]["action"] == "elif":
+                start = self.__get_start_pos(condition[i]["start"], response, "elif")
+                end = condition[i]["end"]
+            elif condition[i]["action"] == "endif":
+                check = False
+        session.attr["_quote"] = _quote
+        session.attr["substitute"] = substitute
+        return ((self._check_and_evaluate_condition(session, response, condition[matched_index]["within"],
+                                                    condition[matched_index]["end"] + 2,
+                                                    condition[matched_index + 1]["start"] - 2)
+                 if matched_index is not None else ""), i)
+
+    def __handler(self, session, condition, response, action):
+        return self._check_and_evaluate_condition(
+            session, response, condition["child"], self.__get_start_pos(condition["start"], response, action),
+            condition["end"])
+
+    def __low_handler(self, session, condition, response):
+        return self.__handler(session, condition, response, "low").lower()
+
+    def __up_handler(self, session, condition, response):
+        return self.__handler(session, condition, response, "up").upper()
+
+    def __cap_handler(self, session, condition, response):
+        return self.__handler(session, condition, response, "cap").capitalize()
+
+    @staticmethod
+    def __get_start_pos(start, response, exp):
+        return start + re.compile(r"([\s\t]*" + exp + r"[\s\t]+)").search(response[start:]).end(1)
+
+    def __map_handler(self, session, condition, response):
+        start = condition["start"]
+        end = condition["end"]
+        think = False
+        if response[start] == "!":
+            think = True
+            start += 1
+        content = self._check_and_evaluate_condition(session, response, condition["child"], start,
+                                                     end).strip().split(":")
+        name = content[0]
+        this_index = 0
+        for this_index in range(1, len(content)):
+            if name[-1] == "\\":
+                name += ":" + content[this_index]
+            else:
+                this_index -= 1
+                break
+        this_index += 1
+        name = name.strip().lower()
+        if this_index < (len(content)):
+            value = content[this_index]
+            for this_index in range(this_index + 1, len(content)):
+                if value[-1] == "\\":
+                    value += ":" + content[this_index]
+                else:
+                    break
+            session.memory[name] = self._substitute(session, value.strip())
+        if think:
+            return ""
+        return session.memory.get(name, "")
+
+    def _quote(self, session, string):
+        if session.attr["_quote"]:
+            try:
+                return quote(string)
+            except TypeError:
+                return quote(string.encode("UTF-8"))
+        return string
+
+    def __substitute_from_client_statement(self, session, match, prev_response, silent=False):
+        prev = 0
+        if silent:
+            start_padding = 2
+            re_numbered_group = RE_NUMBERED_GROUP_SILENT
+            re_named_group = RE_NAMED_GROUP_SILENT
+        else:
+            start_padding = 1
+            re_numbered_group = RE_NUMBERED_GROUP
+            re_named_group = RE_NAMED_GROUP
+        final_response = ""
+        for m in re_numbered_group.finditer(prev_response):
+            start = m.start(0)
+            end = m.end(0)
+            num = int(prev_response[start + start_padding:end])
+            final_response += prev_response[prev:start]
+            try:
+                final_response += self._quote(session, self._substitute(session, match.group(num)))
+            except IndexError:
+                pass
+            prev = end
+        named_group = match.groupdict()
+        prev_response = final_response + prev_response[prev:]
+        final_response = ""
+        prev = 0
+        for m in re_named_group.finditer(prev_response):
+            start = m.start(1)
+            end = m.end(1)
+            final_response += prev_response[prev:start - start_padding]
+            value = named_group.get(prev_response[start:end], "").strip()
+            if value:
+                final_response += self._quote(session, self._substitute(session, value))
+            prev = end
+        return final_response + prev_response[prev:]
+
+    def _check_and_evaluate_condition(self, session, response, condition=(), start_index=0, end_index=None):
+        end_index = end_index if end_index is not None else len(response)
+        if not condition:
+            final_response = self.__substitute_from_client_statement(
+                session, session.attr["match"], response[start_index:end_index])
+            parent_match = session.attr["pmatch"]
+            if parent_match is None:
+                return final_response
+            return self.__substitute_from_client_statement(session, parent_match, final_response, silent=True)
+        i = 0
+        final_response = ""
+        _quote = session.attr.get("_quote", True)
+        while i < len(condition):
+            pos = condition[i]["start"] - (1 if condition[i]["action"] in ("map", "eval") else 2)
+            final_response += self._check_and_evaluate_condition(session, response[start_index:pos])
+            try:
+                session.attr["_quote"] = False
+                temp_response = self.__action_handlers[condition[i]["action"]](session, condition[i], response)
+                session.attr["_quote"] = _quote
+                final_response += self._quote(session, temp_response)
+            except KeyError:
+                session.attr["_quote"] = _quote
+                if condition[i]["action"] == "if":
+                    response_txt, i = self.__if_handler(session, i, condition, response)
+                    final_response += response_txt
+            start_index = condition[i]["end"] + (1 if condition[i]["action"] in ("map", "eval") else 2)
+            i += 1
+        final_response += self._check_and_evaluate_condition(session, response[start_index:end_index])
+        return final_response
+
+    def _wildcards(self, session, response, match, parent_match):
+        session.attr["match"] = match
+        session.attr["pmatch"] = parent_match
+        response, condition = response[:2]
+        return re.sub(r'\\([\[\]{}%:])', r"\1", self._check_and_evaluate_condition(session, response, condition))
+
+
+def bench(number=20000):
+    chat = Chat(template_cache=None)
+    walker = TreeWalk(chat)
+    session = mapper.Session(chat, "general")
+    match = re.match(r"(?P<name>\w+) (\w+) (?P<other>\w+)", "Alice 5 pears")
+    print("%-10s %12s %12s %8s" % ("response", "plan", "tree walk", "speedup"))
+    for index, text in enumerate(RESPONSES):
+        compiled = chat._Chat__compile_response(text)
+        expected = walker._wildcards(session, compiled, match, None)
+        assert chat._wildcards(session, compiled, match, None) == expected, text
+        plan = min(timeit.repeat(lambda: chat._wildcards(session, compiled, match, None), number=number, repeat=3))
+        walk = min(timeit.repeat(lambda: walker._wildcards(session, compiled, match, None), number=number, repeat=3))
+        print("%-10d %10.2fus %10.2fus %7.1fx" % (index, plan / number * 1e6, walk / number * 1e6, walk / plan))
+
+
+if __name__ == '__main__':
+    bench()
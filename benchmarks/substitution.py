@@ -0,0 +1,48 @@
+import random
+import re
+import timeit
+from chatbot import Chat
+from chatbot.substitution import TokenTrie
+
+MESSAGES = [
+    "I'm not sure my friend wants to come",
+    "yep gonna do it, you know what I mean",
+    "What is the weather like in Paris today?",
+    "Nope, I've never been there and I don't wanna go",
+]
+
+
+def regex_table(table):
+    keys = sorted(table, key=len, reverse=True)
+    regex = re.compile(r"\b({0})\b".format("|".join(map(re.escape, keys))), re.IGNORECASE)
+    return lambda text: regex.sub(lambda mo: table[mo.group(0).lower()], text)
+
+
+def trie_table(table):
+    return TokenTrie(table).sub
+
+
+def bench(number=20000):
+    table = {key.lower(): value for key, value in Chat(template_cache=None).substitution.normal.items()}
+    words = ["".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(3, 9)))
+             for _ in range(4001)]
+    large = dict(table)
+    large.update(("%s %s" % (words[i], words[i + 1]) if i % 3 else words[i], words[i + 1]) for i in range(2000))
+    print("%-8s %8s %12s %12s %12s %8s" % ("table", "entries", "compile", "regex", "trie", "speedup"))
+    for name, substitutions in (("default", table), ("large", large)):
+        # skip the pattern cache of the re module
+        compile_regex = min(timeit.repeat(lambda: (re.purge(), regex_table(substitutions)("warm up")), number=1,
+                                          repeat=3))
+        compile_trie = min(timeit.repeat(lambda: trie_table(substitutions)("warm up"), number=1, repeat=3))
+        regex, trie = regex_table(substitutions), trie_table(substitutions)
+        assert all(regex(message) == trie(message) for message in MESSAGES)
+        slow = min(timeit.repeat(lambda: [regex(message) for message in MESSAGES], number=number, repeat=3))
+        fast = min(timeit.repeat(lambda: [trie(message) for message in MESSAGES], number=number, repeat=3))
+        size = number * len(MESSAGES)
+        print("%-8s %8d %5.0fms/%4.0fms %10.2fus %10.2fus %7.1fx" % (
+            name, len(substitutions), compile_regex * 1e3, compile_trie * 1e3, slow / size * 1e6,
+            fast / size * 1e6, slow / fast))
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,12 +1,28 @@
 import re
 import random
-import requests
 import json
+import inspect
+import asyncio
+import threading
+import weakref
 from os import path
+from time import perf_counter
 from functools import partial
-from .substitution import Substitution
-from .spellcheck import SpellChecker
+from concurrent.futures import ThreadPoolExecutor
+from .substitution import Substitution, TokenTrie
+from .spellcheck import SpellChecker, DEFAULT_CACHE_SIZE
+from .matcher import IntentMatcher, PreviousPattern
+from .learned import LearnedIntents, DEFAULT_CAPACITY
+from .resources import ResourceRegistry
+from .api import ApiClient
+from .template_cache import TemplateCache, user_cache_directory
+from .singleflight import SingleFlight
+from .effects import BlockingEffect, CallEffect, gather, run, arun
+from .metrics import MessageMetrics, SlowMessageLog, timed, logger
+from .render import (TEXT, ACTION, RenderContext, compile_plan, RE_NAMED_GROUP, RE_NAMED_GROUP_SILENT,
+                     RE_NUMBERED_GROUP, RE_NUMBERED_GROUP_SILENT, RE_ESCAPED)
 from . import version
+from . import batch
 from . import mapper
 from .constants import FIRST_QUESTIONS, TERMINATES, LANGUAGE_SUPPORT  # noqa: F401
 
@@ -22,28 +38,35 @@ except NameError:
 
 __version__ = version.__version__
 
+DEFAULT_CONVERSATION_DEPTH = None
 DEFAULT_ATTRIBUTE = {"match": None, "pmatch": None, "_quote": False, "substitute": True}
+SPELL_CORRECTION_POLICIES = ("never", "fallback", "eager")
+LEARN_SCOPES = ("global", "session")
 RE_TAG_PARENTHESIS = re.compile(r'{%?|%?}|\[|\]')
 RE_OPERATORS = re.compile(r'([\<\>!=]=|[\<\>]|&|\|)')
-RE_NAMED_GROUP = re.compile(r'%([a-zA-Z_][a-zA-Z_0-9]*)([^a-zA-Z_0-9]|$)')
-RE_NAMED_GROUP_SILENT = re.compile(r'%!([a-zA-Z_][a-zA-Z_0-9]*)([^a-zA-Z_0-9]|$)')
-RE_NUMBERED_GROUP = re.compile(r'%[0-9]+')
-RE_NUMBERED_GROUP_SILENT = re.compile(r'%![0-9]+')
 
 
 class MultiFunctionCall:
 
-    def __init__(self, func=None):
+    def __init__(self, func=None, coalesce=None):
+        """
+        :type func: dict
+        :param func: functions by name
+        :type coalesce: set
+        :param coalesce: names of the functions whose concurrent calls with the same argument share one execution
+        """
         self.__func__ = {} if func is None else func
+        self.coalesce = set() if coalesce is None else coalesce
+        self._flight = SingleFlight()
 
     @staticmethod
     def default_func(session, string):
         return string
 
-    def call(self, session, string):
+    def __resolve(self, string):
         s = string.split(":")
         if len(s) <= 1:
-            return string
+            return None, None, string
         name = s[0].strip()
         s = ":".join(s[1:])
         func = self.default_func
@@ -51,14 +74,58 @@ class MultiFunctionCall:
             func = self.__func__[name]
         except KeyError:
             s = string
-        new_string = re.sub(r'([\[\]{}%:])', r"\\\1", s)
-        return re.sub(r'\\([\[\]{}%:])', r"\1", func(session, new_string))
+            name = None
+        return name, func, re.sub(r'([\[\]{}%:])', r"\\\1", s)
+
+    @staticmethod
+    def __invoke(func, session, string):
+        result = func(session, string)
+        if inspect.iscoroutine(result):
+            result.close()
+            raise TypeError("'%s' is a coroutine function, use asay or arespond" % func.__name__)
+        return result
+
+    @staticmethod
+    async def __ainvoke(func, session, string):
+        result = func(session, string)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    def call(self, session, string):
+        name, func, new_string = self.__resolve(string)
+        if func is None:
+            return string
+        if name in self.coalesce:
+            result = self._flight.do((name, new_string), self.__invoke, func, session, new_string)
+        else:
+            result = self.__invoke(func, session, new_string)
+        return re.sub(r'\\([\[\]{}%:])', r"\1", result)
+
+    async def acall(self, session, string):
+        name, func, new_string = self.__resolve(string)
+        if func is None:
+            return string
+        if name in self.coalesce:
+            result = await self._flight.ado((name, new_string), self.__ainvoke, func, session, new_string)
+        else:
+            result = await self.__ainvoke(func, session, new_string)
+        return re.sub(r'\\([\[\]{}%:])', r"\1", result)
 
 
 _function_call = MultiFunctionCall()
+_resources = ResourceRegistry()
+# the package directory may be read only or shared between users
+_template_cache = TemplateCache(user_cache_directory())
+
 
+def register_call(function_name=None, coalesce=False):
+    """
+    Register a function callable from templates with {% call name: argument %}.
 
-def register_call(function_name=None):
+    With coalesce=True the concurrent calls made with the same argument share
+    one execution, for functions whose result doesn't depend on the session.
+    """
     def wrap(function):
         if type(function).__name__ != 'function':
             raise TypeError("function expected found %s" % type(function).__name__)
@@ -66,10 +133,12 @@ def register_call(function_name=None):
         if name in function_mapper:
             raise ValueError("function with same name is already registered")
         function_mapper[name] = function
+        if coalesce:
+            _function_call.coalesce.add(name)
         return function
 
     if function_name is None:
-        return register_call
+        return partial(register_call, coalesce=coalesce) if coalesce else register_call
     if type(function_name).__name__ in ('unicode', 'str'):
         name = function_name
         return wrap
@@ -95,34 +164,14 @@ class DummyMatch:
         return {}
 
 
-class Topic:
-
-    def __init__(self, topics):
-        self.topic = {"general": ''}
-        self.topics = topics
-
-    def __setitem__(self, key, value):
-        value = value.strip()
-        if value and value[0] == ".":
-            index = 1
-            current_topic = self.topic[key].split(".")
-            while value[index] == ".":
-                index += 1
-                current_topic.pop()
-            current_topic.append(value[index:])
-            value = ".".join(current_topic)
-        self.topic[key] = value
-
-    def __getitem__(self, key):
-        topic = self.topic[key]
-        if topic in self.topics():
-            return topic
-        return ''
-
-
 class Chat(object):
     def __init__(self, pairs=(), reflections=None, call=_function_call,
-                 api=None, normalizer=None, default_template=None, language="en", local_path=None):
+                 api=None, normalizer=None, default_template=None, language="en", local_path=None,
+                 spell_correction="fallback", resources=_resources, template_cache=_template_cache,
+                 parallel_calls=0, max_sessions=None, session_ttl=None, on_evict=None, backend=None,
+                 conversation_depth=DEFAULT_CONVERSATION_DEPTH, learn_scope="global", max_learned=DEFAULT_CAPACITY,
+                 on_message=None, slow_message_threshold=None, spell_engine="norvig",
+                 spell_cache_size=DEFAULT_CACHE_SIZE):
         """
         Initialize the chatbot.  Pairs is a list of patterns and responses.  Each
         pattern is a regular expression matching the user's statement or question,
@@ -137,25 +186,96 @@ class Chat(object):
         :param reflections: A mapping between first and second person expressions
         :type call: MultiFunctionCall
         :param call: A mapping between user defined function and template function call name
+        :type spell_correction: str
+        :param spell_correction: When the spell corrected message is matched, one of
+            "never", "fallback" (only after the raw message found no match in the topic chain,
+            up to the first topic with default responses) or "eager" (right after the raw message
+            in each topic)
+        :type resources: ResourceRegistry
+        :param resources: Registry sharing the spell checker, substitutions and compiled default
+            template between Chat instances of the same language, None to load them for this Chat only
+        :type template_cache: TemplateCache
+        :param template_cache: On-disk cache of compiled template files, by default in the cache directory
+            of the user (see template_cache.user_cache_directory), None to always compile them
+        :type parallel_calls: int
+        :param parallel_calls: Threads running the independent call and eval tags of a response side by
+            side, 0 to run them one after the other
+        :type max_sessions: int
+        :param max_sessions: Sessions kept in memory, the least recently used ones are dropped first,
+            None to keep every session
+        :type session_ttl: float
+        :param session_ttl: Seconds of inactivity after which a session is dropped, None to keep it forever
+        :type on_evict: function
+        :param on_evict: Called with the Session about to be dropped, e.g. to save it. When it raises the
+            exception is logged by the "chatbot" logger and the session is kept
+        :type backend: backend.SessionBackend
+        :param backend: Storage the sessions are loaded from on first use and saved to after every message,
+            None to keep them in memory only
+        :type conversation_depth: int
+        :param conversation_depth: Last messages kept in the conversation of a session, None (default) to keep them all
+        :type learn_scope: str
+        :param learn_scope: Who gets the blocks taught by learn tags, "global" (every session) or "session"
+            (only the session they were learned in)
+        :type max_learned: int
+        :param max_learned: Learned blocks and defaults kept (per session with the "session" scope), the least
+            recently learned are dropped first
+        :type on_message: function
+        :param on_message: Called with the metrics.MessageMetrics of every reply (time spent per stage,
+            patterns tried, topic depth and cache statistics), None to not collect them
+        :type slow_message_threshold: float
+        :param slow_message_threshold: Seconds from which a reply is logged, with the time of each stage,
+            as a warning of the "chatbot" logger, None to not log slow replies
+        :type spell_engine: str
+        :param spell_engine: Candidate engine of the spell checker, "norvig" or "symspell" (faster corrections,
+            for a large index built on the first correction, see spellcheck.SpellChecker)
+        :type spell_cache_size: int
+        :param spell_cache_size: Corrected words remembered by the spell checker, None for unbounded and 0 to
+            disable
         :rtype: None
         """
+        if spell_correction not in SPELL_CORRECTION_POLICIES:
+            raise ValueError("spell_correction should be one of %s found '%s'" % (
+                ", ".join(SPELL_CORRECTION_POLICIES), spell_correction))
+        if learn_scope not in LEARN_SCOPES:
+            raise ValueError("learn_scope should be one of %s found '%s'" % (", ".join(LEARN_SCOPES), learn_scope))
+        if parallel_calls < 0:
+            raise ValueError("parallel_calls should be at least 0 found %d" % parallel_calls)
+        self.spell_correction = spell_correction
+        self._executor = ThreadPoolExecutor(parallel_calls, "chatbot-calls") if parallel_calls else None
+        # what say_many workers build their own Chat from
+        self._arguments = dict(pairs=pairs, reflections=reflections, call=call, api=api, normalizer=normalizer,
+                               default_template=default_template, language=language, local_path=local_path,
+                               spell_correction=spell_correction, template_cache=template_cache,
+                               parallel_calls=parallel_calls, max_sessions=max_sessions,
+                               session_ttl=session_ttl, on_evict=on_evict, backend=backend,
+                               conversation_depth=conversation_depth, learn_scope=learn_scope,
+                               max_learned=max_learned, on_message=on_message,
+                               slow_message_threshold=slow_message_threshold, spell_engine=spell_engine,
+                               spell_cache_size=spell_cache_size)
+        if resources is None:
+            self._arguments["resources"] = None
         self.__init__handler()
         if local_path is None:
             self.local_path = path.join(path.dirname(path.abspath(__file__)), "local")
         else:
             self.local_path = local_path
-        self.spell_checker = SpellChecker(self.local_path, language)
-        self.substitution = Substitution(self.local_path, language)
+        self._resources = resources
+        self._template_cache = template_cache
+        if resources is None:
+            self.spell_checker = SpellChecker(self.local_path, language, spell_engine, spell_cache_size)
+            self.substitution = Substitution(self.local_path, language)
+        else:
+            self.spell_checker = resources.spell_checker(self.local_path, language, spell_engine, spell_cache_size)
+            self.substitution = resources.substitution(self.local_path, language)
         self._re_tags = re.compile(r'^[\s\t]*(if|endif|elif|else|chat|low|up|cap|call|topic)[\s\t]+')
         self._re_block_tags = re.compile(
             r'{%[\s\t]*((end)?(block|learn|response|client|prev|group))[\s\t]*([^%]*|%(?=[^}]))%}')
         if default_template is None:
             default_template = path.join(self.local_path, language, "default.template")
-        default_pairs = self.__process_template_file(default_template)
+        template = None
         if type(pairs).__name__ in ('unicode', 'str'):
-            pairs = self.__process_template_file(pairs)
-        self._pairs = {'': {"pairs": [], "defaults": []}}
-        if not isinstance(pairs, dict):
+            template, pairs = pairs, {}
+        elif not isinstance(pairs, dict):
             pairs = {'': {"pairs": pairs, "defaults": []}}
         elif '' not in pairs:
             raise KeyError("Default topic missing")
@@ -163,17 +283,45 @@ class Chat(object):
         self._normalizer = {}
         for key in normalizer:
             self._normalizer[key.lower()] = normalizer[key]
-        self._normalizer_regex = self._compile_reflections(normalizer)
-        self.__process_learn(default_pairs)
-        self.__process_learn(pairs)
+        self._normalizer_trie = self._compile_reflections(self._normalizer)
+        self._pairs = {}
+        self._matchers = {}
+        self._learn_lock = threading.Lock()
+        # a session lock lives as long as somebody holds or waits for it
+        self._session_locks = weakref.WeakValueDictionary()
+        self._session_locks_lock = threading.Lock()
+        self._sessions = None
+        if max_sessions is not None or session_ttl is not None:
+            self._sessions = mapper.SessionTracker(max_sessions, session_ttl)
+        self._on_evict = on_evict
+        self._backend = backend
+        self._on_message = on_message
+        self._slow_messages = None if slow_message_threshold is None else SlowMessageLog(slow_message_threshold)
+        # nothing is measured unless somebody looks at it
+        self._instrumented = on_message is not None or slow_message_threshold is not None
+        if resources is None:
+            self.__add_pairs(*self.__load_template(default_template))
+        else:
+            # learning only prepends to this Chat's own lists, the shared blocks are never changed
+            self.__add_pairs(*resources.get(
+                ("template", path.abspath(default_template), tuple(sorted(self._normalizer.items()))),
+                partial(self.__load_template, default_template)))
+        self.__add_pairs({'': {"pairs": [], "defaults": []}})
+        if template is None:
+            self.__process_learn(pairs)
+        else:
+            self.__add_pairs(*self.__load_template(template))
         self._reflections = reflections or self.substitution.reflections
-        self._regex = self._compile_reflections(self._reflections)
-        self._memory = mapper.SessionHandler(dict, general={})
-        self._conversation = mapper.SessionHandler(mapper.Conversation, general=[])
-        self._attr = mapper.SessionHandler(dict, general=DEFAULT_ATTRIBUTE.copy())
+        self._reflections_trie = self._compile_reflections(self._reflections)
+        self._conversation_depth = conversation_depth
+        self.learn_scope = learn_scope
+        self._max_learned = max_learned
+        self._learned = LearnedIntents(max_learned) if learn_scope == "global" else None
+        # one bound method shared by the conversations of every session
+        self._normalize = self.__normalize
+        self._states = {"general": self.__new_state()}
         self.call = call
-        self._topic = Topic(self._pairs.keys)
-        self._api = self.__process_api(api)
+        self._api = ApiClient(self.__process_api(api))
 
     @staticmethod
     def __process_api(api):
@@ -226,7 +374,7 @@ class Chat(object):
         :param text: The string to be normalized
         :rtype: str
         """
-        return self._normalizer_regex.sub(lambda mo: self._normalizer[mo.string[mo.start():mo.end()].lower()], text)
+        return self._normalizer_trie.sub(text)
 
     @staticmethod
     def __error_message(expected, text, pos, index):
@@ -259,7 +407,8 @@ class Chat(object):
                 index += 1
                 if pos[index][2] != "endprev":
                     raise SyntaxError(self.__error_message("endprev", text, pos, index))
-                within_block["prev"].append(text[pos[index - 1][1]:pos[index][0]].strip(" \t\n"))
+                pattern = text[pos[index - 1][1]:pos[index][0]].strip(" \t\n")
+                within_block["prev"].append(self.__prev_tag(pattern, pos[index - 1][3], text, pos, index))
             else:
                 content = text[max(0, pos[index - 1][0]): pos[index][1] + 5].strip()
                 raise NameError("Invalid Tag '%s':  Error in `%s` " % (pos[index][2], content))
@@ -271,6 +420,21 @@ class Chat(object):
             within_block["learn"],
         )
 
+    def __prev_tag(self, pattern, arguments, text, pos, index):
+        # {% prev [bot|user] [depth] %}, a plain pattern for the last bot message
+        speaker, depth = "bot", 1
+        for argument in arguments.split():
+            if argument in ("bot", "user"):
+                speaker = argument
+            elif argument.isdigit() and int(argument) > 0:
+                depth = int(argument)
+            else:
+                raise SyntaxError("Invalid prev argument '%s' in line `%s`" % (
+                    argument, text[pos[index - 1][0]:pos[index][1]].strip()))
+        if speaker == "bot" and depth == 1:
+            return pattern
+        return pattern, speaker, depth
+
     def __group_tags(self, text, pos, groups, condition, length, index=0, name=""):
         pairs = []
         defaults = []
@@ -297,7 +461,9 @@ class Chat(object):
 
     def __process_template_file(self, file_name):
         with open(file_name, encoding='utf-8') as template:
-            text = template.read()
+            return self.__process_template(template.read())
+
+    def __process_template(self, text):
         pos = [(m.start(0), m.end(0), text[m.start(1):m.end(1)], text[m.start(4):m.end(4)])
                for m in self._re_block_tags.finditer(text)]
         length = len(pos)
@@ -312,20 +478,25 @@ class Chat(object):
             patterns = [patterns]
         regexps = []
         for pattern in patterns:
+            # (pattern, "bot" or "user", depth) prev patterns
+            previous = None if isinstance(pattern, str) else pattern
+            if previous is not None:
+                pattern = previous[0]
             try:
-                regexps.append(re.compile(self.__normalize(pattern), re.IGNORECASE))
+                regexp = re.compile(self.__normalize(pattern), re.IGNORECASE)
             except Exception as e:
                 e.args = (str(e) + " in pattern " + pattern,)
                 raise e
+            if previous is not None:
+                regexp = PreviousPattern(regexp, previous[1] == "bot", previous[2])
+            regexps.append(regexp)
         return regexps
 
-    def __process_learn(self, pairs):
+    def __compile_pairs(self, pairs):
+        compiled = {}
         for topic in pairs:
-            if topic not in self._pairs:
-                self._pairs[topic] = {"pairs": [], "defaults": []}
-            self._pairs[topic]["defaults"].extend([(i, self._condition(i))
-                                                   for i in pairs[topic].get("defaults", [])])
-            for pair in pairs[topic]["pairs"][::-1]:
+            blocks = []
+            for pair in pairs[topic]["pairs"]:
                 learn, previous = {}, None
                 length = len(pair)
                 if length > 3:
@@ -343,16 +514,130 @@ class Chat(object):
                     raise TypeError("Invalid Type for learn expected dict got '%s'" % type(learn).__name__)
                 if not client:
                     raise ValueError("Each block should contain at least 1 client regex")
-                self._pairs[topic]["pairs"].insert(0, (self.__build_pattern(client),
-                                                       self.__build_pattern(previous),
-                                                       tuple((i, self._condition(i)) for i in responses),
-                                                       learn))
+                blocks.append((self.__build_pattern(client),
+                               self.__build_pattern(previous),
+                               tuple(self.__compile_response(i) for i in responses),
+                               learn))
+            compiled[topic] = {"pairs": blocks,
+                               "defaults": [self.__compile_response(i) for i in pairs[topic].get("defaults", [])]}
+        return compiled
+
+    def __compile_response(self, response):
+        condition = self._condition(response)
+        return response, condition, compile_plan(response, condition)
+
+    def __add_pairs(self, pairs, matchers=None):
+        # copy on write, replies being computed on other threads keep the lists and matcher they started with
+        with self._learn_lock:
+            for topic in pairs:
+                blocks = pairs[topic]["pairs"]
+                if topic in self._pairs:
+                    matcher = self._matchers[topic].copy()
+                    if matchers:
+                        matcher.prepend_matcher(matchers[topic])
+                    else:
+                        matcher.prepend(blocks)
+                    topic_pairs = {"pairs": list(blocks) + self._pairs[topic]["pairs"],
+                                   "defaults": self._pairs[topic]["defaults"] + list(pairs[topic]["defaults"])}
+                else:
+                    matcher = matchers[topic].copy() if matchers else IntentMatcher(blocks)
+                    topic_pairs = {"pairs": list(blocks), "defaults": list(pairs[topic]["defaults"])}
+                # the matcher first, so a topic found in _pairs always has one
+                self._matchers[topic] = matcher
+                self._pairs[topic] = topic_pairs
+
+    def __load_template(self, file_name):
+        if self._template_cache is None:
+            pairs = self.__compile_pairs(self.__process_template_file(file_name))
+            return pairs, {topic: IntentMatcher(pairs[topic]["pairs"]) for topic in pairs}
+        with open(file_name, "rb") as template:
+            text = template.read()
+        key = self._template_cache.key(text, tuple(sorted(self._normalizer.items())))
+        compiled = self._template_cache.load(file_name, key)
+        if compiled is None:
+            # same newline translation as reading the file in text mode
+            pairs = self.__compile_pairs(self.__process_template(
+                text.decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")))
+            compiled = pairs, {topic: IntentMatcher(pairs[topic]["pairs"]) for topic in pairs}
+            self._template_cache.dump(file_name, key, compiled)
+        return compiled
+
+    def __process_learn(self, pairs):
+        self.__add_pairs(self.__compile_pairs(pairs))
+
+    def __learned(self, session, create=False):
+        # the template blocks never change, learned ones go to a bounded overlay
+        if self._learned is not None:
+            return self._learned
+        state = session.state
+        if state.learned is None and create:
+            state.learned = LearnedIntents(self._max_learned)
+        return state.learned
+
+    def _has_topic(self, topic, state):
+        learned = self._learned if self._learned is not None else state.learned
+        return topic in self._pairs or (learned is not None and topic in learned)
+
+    def __new_state(self, topic=''):
+        return mapper.SessionState({}, DEFAULT_ATTRIBUTE.copy(), topic.strip(),
+                                   mapper.Conversation(depth=self._conversation_depth, normalizer=self._normalize))
 
     def start_new_session(self, session_id, topic=''):
-        self._memory[session_id] = {}
-        self._conversation[session_id] = []
-        self._attr[session_id] = DEFAULT_ATTRIBUTE.copy()
-        self._topic[session_id] = topic
+        self._states[session_id] = self.__new_state(topic)
+        if self._backend is not None:
+            self._save_session(session_id)
+        if self._sessions is not None:
+            self.__evict(self._sessions.touch(session_id))
+
+    def _use_session(self, session_id):
+        """
+        Start a session on its first message (or load it from the backend, also after it
+        was evicted) and mark it as used.
+        """
+        if session_id not in self._states:
+            state = None if self._backend is None else self._backend.load(session_id)
+            if state is None:
+                self.start_new_session(session_id)
+                return
+            self._states[session_id] = mapper.SessionState.load(state, DEFAULT_ATTRIBUTE, self._conversation_depth,
+                                                                self._normalize)
+        if self._sessions is not None:
+            self.__evict(self._sessions.touch(session_id))
+
+    def _save_session(self, session_id):
+        self._backend.save(session_id, self._states[session_id].dump())
+
+    def evict_sessions(self):
+        """
+        Drop the sessions idle for more than session_ttl seconds. Expired sessions are
+        otherwise only dropped when a message arrives.
+        """
+        if self._sessions is not None:
+            self.__evict(self._sessions.touch())
+
+    def __evict(self, session_ids):
+        for session_id in session_ids:
+            lock = self._session_lock(session_id)
+            async_lock = self._session_locks.get((session_id, True))
+            # a session answering a message right now is kept
+            if (async_lock is not None and async_lock.locked()) or not lock.acquire(blocking=False):
+                self._sessions.keep(session_id)
+                continue
+            try:
+                if session_id not in self._states:
+                    continue
+                if self._on_evict is not None:
+                    try:
+                        self._on_evict(mapper.Session(self, session_id))
+                    except Exception:
+                        # the message that triggered the eviction may be of another session, don't fail its
+                        # reply, keep the session for the callback to be called again on its next eviction
+                        logger.exception("on_evict failed for session %s, the session is kept", session_id)
+                        self._sessions.keep(session_id)
+                        continue
+                del self._states[session_id]
+            finally:
+                lock.release()
 
     @staticmethod
     def remove_items(items, to_remove):
@@ -509,10 +794,9 @@ class Chat(object):
 
     @staticmethod
     def _compile_reflections(normal):
-        sorted_reflection = sorted(normal.keys(), key=len, reverse=True)
-        return re.compile(r"\b({0})\b".format("|".join(map(re.escape, sorted_reflection))), re.IGNORECASE)
+        return TokenTrie(normal)
 
-    def _substitute(self, session, text):
+    def _substitute(self, session, text, context=None):
         """
         Substitute words in the string, according to the specified reflections,
         e.g. "I'm" -> "you are"
@@ -521,11 +805,13 @@ class Chat(object):
         :param session: Session object
         :type text: str
         :param text: The string to be mapped
+        :type context: RenderContext
+        :param context: Rendering in progress, None to use the session attributes
         :rtype: str
         """
-        if not session.attr.get("substitute", True):
+        if not (session.attr.get("substitute", True) if context is None else context.substitute):
             return text
-        return self._regex.sub(lambda mo: self._reflections[mo.string[mo.start():mo.end()]], text.lower())
+        return self._reflections_trie.sub(text.lower())
 
     def _check_if(self, session, con):
         pos = [(m.start(0), m.end(0), m.group(0)) for m in RE_OPERATORS.finditer(con)]
@@ -554,91 +840,52 @@ class Chat(object):
             first = second
         return self.__logical_operator[symbol](prev_res, res)
 
-    def __if_handler(self, session, i, condition, response):
-        start = self.__get_start_pos(condition[i]["start"], response, "if")
-        end = condition[i]["end"]
-        check = True
-        matched_index = None
-        _quote = session.attr["_quote"]
-        session.attr["_quote"] = False
-        substitute = session.attr.get("substitute", True)
-        session.attr["substitute"] = False
-        while check:
-            con = self._check_and_evaluate_condition(session, response, condition[i]["child"],
-                                                     start, end)
-            i += 1
-            if self._check_if(session, con):
-                matched_index = i - 1
-                while condition[i]["action"] != "endif":
-                    i += 1
-                check = False
-            elif condition[i]["action"] == "else":
-                matched_index = i
-                while condition[i]["action"] != "endif":
-                    i += 1
-                check = False
-            elif condition[i]["action"] == "elif":
-                start = self.__get_start_pos(condition[i]["start"], response, "elif")
-                end = condition[i]["end"]
-            elif condition[i]["action"] == "endif":
-                check = False
-        session.attr["_quote"] = _quote
-        session.attr["substitute"] = substitute
-        return ((self._check_and_evaluate_condition(session, response,
-                                                    condition[matched_index]["within"],
-                                                    condition[matched_index]["end"] + 2,
-                                                    condition[matched_index + 1]["start"] - 2
-                                                    ) if matched_index is not None else ""), i)
-
-    def __handler(self, session, condition, response, action):
-        return self._check_and_evaluate_condition(
-            session, response, condition["child"], self.__get_start_pos(condition["start"], response, action),
-            condition["end"])
-
-    def __chat_handler(self, session, condition, response):
-        substitute = session.attr.get("substitute", True)
-        session.attr["substitute"] = False
-        match = session.attr.get("match")
-        parent_match = session.attr.get("pmatch")
-        response = self._respond(session, self.__handler(session, condition, response, "chat"))
-        session.attr["substitute"] = substitute
-        session.attr["match"] = match
-        session.attr["pmatch"] = parent_match
-        return response
+    def __if_handler(self, session, op, context):
+        _, conditions, bodies, matched = op
+        condition_context = context.replace(quote=False, substitute=False)
+        metrics = session.metrics
+        for condition, body in zip(conditions, bodies):
+            start = None if metrics is None else perf_counter()
+            holds = self._check_if(session, (yield from self.__render(session, condition, condition_context)))
+            if metrics is not None:
+                metrics.add("condition", perf_counter() - start)
+            if holds:
+                matched = body
+                break
+        return (yield from self.__render(session, matched, context)) if matched is not None else ""
 
-    def __low_handler(self, session, condition, response):
-        return self.__handler(session, condition, response, "low").lower()
+    def __handler(self, session, op, context):
+        return (yield from self.__render(session, op[2], context))
 
-    def __up_handler(self, session, condition, response):
-        return self.__handler(session, condition, response, "up").upper()
+    def __chat_handler(self, session, op, context):
+        context = context.replace(substitute=False)
+        return (yield from self.__respond(session, (yield from self.__handler(session, op, context)), context))
 
-    def __cap_handler(self, session, condition, response):
-        return self.__handler(session, condition, response, "cap").capitalize()
+    def __low_handler(self, session, op, context):
+        return (yield from self.__handler(session, op, context)).lower()
 
-    def __call_handler(self, session, condition, response):
-        substitute = session.attr.get("substitute", True)
-        session.attr["substitute"] = False
-        response = self.call.call(session, self.__handler(session, condition, response, "call"))
-        session.attr["substitute"] = substitute
-        return response
+    def __up_handler(self, session, op, context):
+        return (yield from self.__handler(session, op, context)).upper()
 
-    def __topic_handler(self, session, condition, response):
-        session.topic = self.__handler(session, condition, response, "topic").strip()
+    def __cap_handler(self, session, op, context):
+        return (yield from self.__handler(session, op, context)).capitalize()
+
+    def __call_handler(self, session, op, context):
+        argument = yield from self.__handler(session, op, context.replace(substitute=False))
+        metrics = session.metrics
+        start = None if metrics is None else perf_counter()
+        try:
+            return (yield CallEffect(self.call, session, argument))
+        finally:
+            if metrics is not None:
+                metrics.add("call", perf_counter() - start, argument.split(":")[0].strip())
+
+    def __topic_handler(self, session, op, context):
+        session.topic = (yield from self.__handler(session, op, context)).strip()
         return ""
 
-    @staticmethod
-    def __get_start_pos(start, response, exp):
-        return start + re.compile(r"([\s\t]*" + exp + r"[\s\t]+)").search(response[start:]).end(1)
-
-    def __map_handler(self, session, condition, response):
-        start = condition["start"]
-        end = condition["end"]
-        think = False
-        if response[start] == "!":
-            think = True
-            start += 1
-        content = self._check_and_evaluate_condition(session, response, condition["child"], start,
-                                                     end).strip().split(":")
+    def __map_handler(self, session, op, context):
+        content = (yield from self.__handler(session, op, context)).strip().split(":")
         name = content[0]
         this_index = 0
         for this_index in range(1, len(content)):
@@ -656,23 +903,13 @@ class Chat(object):
                     value += ":" + content[this_index]
                 else:
                     break
-            session.memory[name] = self._substitute(session, value.strip())
-        if think:
+            session.memory[name] = self._substitute(session, value.strip(), context)
+        if op[3]:
             return ""
         return session.memory.get(name, "")
 
-    def __eval_handler(self, session, condition, response):
-        start = condition["start"]
-        end = condition["end"]
-        think = False
-        if response[start] == "!":
-            think = True
-            start += 1
-        _quote = session.attr["_quote"]
-        session.attr["_quote"] = True
-        content = self._check_and_evaluate_condition(session, response, condition["child"], start,
-                                                     end).strip()
-        session.attr["_quote"] = _quote
+    def __eval_handler(self, session, op, context):
+        content = (yield from self.__handler(session, op, context.replace(quote=True))).strip()
         values = content.split(",")
         names = values[0].split(":")
         api_name = names[0]
@@ -687,69 +924,26 @@ class Chat(object):
             elif key is not None:
                 data[key] += "," + pair[0]
             else:
-                raise SyntaxError("invalid syntax '%s'" % response[start:end])
-        result = self.__api_handler(api_name, method_name, data)
-        return "" if think else result
-
-    def __api_request(self, url, method, **karg):
-        try:
-            return requests.__dict__[method.lower().strip()](url, **karg)
-        except requests.exceptions.MissingSchema:
-            return self.__api_request("http://" + url, method, **karg)
-        except requests.exceptions.ConnectionError:
-            raise RuntimeError("Couldn't connect to server (unreachable). Check your network")
-        except KeyError:
-            raise RuntimeError("Invalid method name '%s' in api.json" % method)
-
-    def __api_handler(self, api_name, method_name, data={}):
-        if api_name not in self._api or method_name not in self._api[api_name]:
-            raise RuntimeError("Invalid method name '%s' for api '%s' ", (method_name, api_name))
-        api_params = dict(self._api[api_name][method_name])
-        if "auth" in self._api[api_name]:
-            try:
-                api_params["cookies"] = self.__api_request(**self._api[api_name]["auth"]).cookies
-            except TypeError:
-                raise ValueError("In api.json 'auth' of '%s' is wrongly configured." % api_name)
-        param = "params" if self._api[api_name][method_name]["method"].upper().strip() == "GET" else "data"
+                raise SyntaxError("invalid syntax '%s'" % op[4])
+        metrics = session.metrics
+        start = None if metrics is None else perf_counter()
         try:
-            api_params[param].update(data)
-        except KeyError:
-            api_params[param] = data
-        api_type = "normal"
-        if "type" in api_params:
-            api_type = api_params["type"]
-            del api_params["type"]
-        api_data_getter = []
-        if "value_getter" in api_params:
-            api_data_getter = api_params["value_getter"]
-            del api_params["value_getter"]
-        response = self.__api_request(**api_params)
-        response_text = response.json() if api_type.upper().strip() == "JSON" else response.content
-        for key in api_data_getter:
-            response_text = response_text[key]
-        return response_text
-
-    def _quote(self, session, string):
-        if session.attr["_quote"]:
+            result = yield BlockingEffect(self._api.request, api_name, method_name, data)
+        finally:
+            if metrics is not None:
+                metrics.add("eval", perf_counter() - start, "%s:%s" % (api_name, method_name))
+        return "" if op[3] else result
+
+    def _quote(self, session, string, context=None):
+        if session.attr["_quote"] if context is None else context.quote:
             try:
                 return quote(string)
             except TypeError:
                 return quote(string.encode("UTF-8"))
         return string
 
-    def __substitute_from_client_statement(self, session, match, prev_response, silent=False):
-        """
-        Substitute from Client statement into response
-        """
+    def __substitute_numbered(self, session, context, match, prev_response, re_numbered_group, start_padding):
         prev = 0
-        if silent:
-            start_padding = 2
-            re_numbered_group = RE_NUMBERED_GROUP_SILENT
-            re_named_group = RE_NAMED_GROUP_SILENT
-        else:
-            start_padding = 1
-            re_numbered_group = RE_NUMBERED_GROUP
-            re_named_group = RE_NAMED_GROUP
         final_response = ""
         for m in re_numbered_group.finditer(prev_response):
             start = m.start(0)
@@ -757,65 +951,161 @@ class Chat(object):
             num = int(prev_response[start + start_padding:end])
             final_response += prev_response[prev:start]
             try:
-                final_response += self._quote(session, self._substitute(session, match.group(num)))
+                final_response += self._quote(session, self._substitute(session, match.group(num), context), context)
             except IndexError:
                 pass
             prev = end
+        return final_response + prev_response[prev:]
+
+    def __substitute_named(self, session, context, match, prev_response, re_named_group, start_padding):
         named_group = match.groupdict()
-        prev_response = final_response + prev_response[prev:]
         final_response = ""
         prev = 0
-
         for m in re_named_group.finditer(prev_response):
             start = m.start(1)
             end = m.end(1)
             final_response += prev_response[prev:start - start_padding]
             value = named_group.get(prev_response[start:end], "").strip()
             if value:
-                final_response += self._quote(session, self._substitute(session, value))
+                final_response += self._quote(session, self._substitute(session, value, context), context)
             prev = end
         return final_response + prev_response[prev:]
 
-    def _check_and_evaluate_condition(self, session, response, condition=[], start_index=0, end_index=None):
-        end_index = end_index if end_index is not None else len(response)
-        if not condition:
-            final_response = self.__substitute_from_client_statement(
-                session, session.attr["match"], response[start_index:end_index])
-            parent_match = session.attr["pmatch"]
-            if parent_match is None:
-                return final_response
-            return self.__substitute_from_client_statement(session, parent_match, final_response,
-                                                           silent=True)
-        i = 0
-        final_response = ""
-        _quote = session.attr.get("_quote", True)
-        while i < len(condition):
-            pos = condition[i]["start"] - (1 if condition[i]["action"] in ("map", "eval") else 2)
-            final_response += self._check_and_evaluate_condition(session, response[start_index:pos])
+    def __substitute_from_client_statement(self, session, context, match, prev_response, silent=False):
+        """
+        Substitute from Client statement into response
+        """
+        if silent:
+            return self.__substitute_named(
+                session, context, match,
+                self.__substitute_numbered(session, context, match, prev_response, RE_NUMBERED_GROUP_SILENT, 2),
+                RE_NAMED_GROUP_SILENT, 2)
+        return self.__substitute_named(
+            session, context, match,
+            self.__substitute_numbered(session, context, match, prev_response, RE_NUMBERED_GROUP, 1),
+            RE_NAMED_GROUP, 1)
+
+    def __render_text(self, session, pieces, context):
+        match = context.match
+        final_response = []
+        for piece in pieces:
+            if isinstance(piece, str):
+                final_response.append(piece)
+                continue
             try:
-                session.attr["_quote"] = False
-                temp_response = self.__action_handlers[condition[i]["action"]](session, condition[i], response)
-                session.attr["_quote"] = _quote
-                final_response += self._quote(session, temp_response)
-            except KeyError:
-                session.attr["_quote"] = _quote
-                if condition[i]["action"] == "if":
-                    response_txt, i = self.__if_handler(session, i, condition, response)
-                    final_response += response_txt
-            start_index = condition[i]["end"] + (1 if condition[i]["action"] in ("map", "eval") else 2)
-            i += 1
-        final_response += self._check_and_evaluate_condition(session, response[start_index:end_index])
-        return final_response
+                final_response.append(self._quote(session, self._substitute(session, match.group(piece), context),
+                                                  context))
+            except IndexError:
+                pass
+        final_response = "".join(final_response)
+        # group references are only left when the text contains a %
+        if "%" not in final_response:
+            return final_response
+        final_response = self.__substitute_named(session, context, match, final_response, RE_NAMED_GROUP, 1)
+        if context.parent_match is None:
+            return final_response
+        return self.__substitute_from_client_statement(session, context, context.parent_match, final_response,
+                                                       silent=True)
+
+    def __independent(self, op):
+        """
+        Whether a tag can run side by side with its neighbours: an eval tag or a call of a
+        coalesced function (whose result doesn't depend on the session) with arguments that
+        at most read the memory.
+        """
+        if op[1] == "call":
+            if op[4].split(":")[0].strip() not in getattr(self.call, "coalesce", ()):
+                return False
+        elif op[1] != "eval":
+            return False
+        for child in op[2]:
+            if child[0] == TEXT:
+                continue
+            if (child[0] != ACTION or child[1] != "map" or ":" in child[4] or
+                    any(grandchild[0] != TEXT for grandchild in child[2])):
+                return False
+        return True
+
+    def __gather(self, session, batch, final_response, context):
+        if not batch:
+            return
+        outcomes = yield from gather(self._executor, [steps for _, steps in batch])
+        for (index, _), (value, error) in zip(batch, outcomes):
+            if isinstance(error, KeyError):
+                continue
+            if error is not None:
+                raise error
+            final_response[index] = self._quote(session, value, context)
+        del batch[:]
+
+    def __render(self, session, plan, context):
+        final_response = []
+        action_context = context.replace(quote=False)
+        # independent tags waiting to run side by side, with their place in the response
+        batch = []
+        for op in plan:
+            if op[0] == TEXT:
+                final_response.append(self.__render_text(session, op[1], context))
+            elif op[0] == ACTION and self._executor is not None and self.__independent(op):
+                batch.append((len(final_response), self.__action_handlers[op[1]](session, op, action_context)))
+                final_response.append("")
+            elif op[0] == ACTION:
+                yield from self.__gather(session, batch, final_response, context)
+                try:
+                    temp_response = yield from self.__action_handlers[op[1]](session, op, action_context)
+                    final_response.append(self._quote(session, temp_response, context))
+                except KeyError:
+                    pass
+            else:
+                yield from self.__gather(session, batch, final_response, context)
+                final_response.append((yield from self.__if_handler(session, op, context)))
+        yield from self.__gather(session, batch, final_response, context)
+        return "".join(final_response)
+
+    @staticmethod
+    def __context(session, match=None, parent_match=None):
+        return RenderContext(match, parent_match, session.attr.get("_quote", False),
+                             session.attr.get("substitute", True))
+
+    def _render(self, session, plan, context=None):
+        """
+        Render a response plan (see render.compile_plan) in the context of the session.
+
+        :type session: Session
+        :param session: Session object
+        :type plan: tuple
+        :param plan: compiled response
+        :type context: RenderContext
+        :param context: client matches and toggles to render with, None to take them from the session attributes
+        :rtype: str
+        """
+        if context is None:
+            context = self.__context(session, session.attr.get("match"), session.attr.get("pmatch"))
+        return run(self.__render(session, plan, context))
+
+    def _check_and_evaluate_condition(self, session, response, condition=[], start_index=0, end_index=None):
+        return self._render(session, compile_plan(response, condition, start_index, end_index))
+
+    def __wildcards(self, session, response, match, parent_match, context):
+        # responses compiled at learn time carry their render plan
+        plan = response[2] if len(response) > 2 else compile_plan(*response)
+        # functions called by the response read the client matches from the session attributes
+        attr = session.attr
+        previous = attr.get("match"), attr.get("pmatch")
+        attr["match"], attr["pmatch"] = match, parent_match
+        try:
+            response = yield from self.__render(session, plan, RenderContext(match, parent_match, context.quote,
+                                                                             context.substitute))
+        finally:
+            attr["match"], attr["pmatch"] = previous
+        return RE_ESCAPED.sub(r"\1", response) if "\\" in response else response
 
     def _wildcards(self, session, response, match, parent_match):
-        session.attr["match"] = match
-        session.attr["pmatch"] = parent_match
-        response, condition = response
-        return re.sub(r'\\([\[\]{}%:])', r"\1", self._check_and_evaluate_condition(session, response, condition))
+        return run(self.__wildcards(session, response, match, parent_match, self.__context(session)))
 
-    def __chose_and_process(self, session, choices, match, parent_match):
+    def __chose_and_process(self, session, choices, match, parent_match, context):
         resp = random.choice(choices)  # pick a random response
-        resp = self._wildcards(session, resp, match, parent_match)  # process wildcards
+        resp = yield from self.__wildcards(session, resp, match, parent_match, context)  # process wildcards
         # fix munged punctuation at the end
         if resp[-2:] == '?.':
             resp = resp[:-2] + '.'
@@ -823,69 +1113,141 @@ class Chat(object):
             resp = resp[:-2] + '?'
         return resp
 
-    def __intend_selection(self, text, previous_text, current_topic):
-        for (patterns, parents, response, learn) in self._pairs[current_topic]["pairs"]:  # check each pattern
-            for pattern in patterns:
-                match = pattern.match(text)
-                if match:
-                    break
-            else:
-                continue
-            if parents is None:
-                return match, None, response, learn
-            for parent in parents:
-                parent_match = parent.match(previous_text)
-                if parent_match:  # did the pattern match?
-                    return match, parent_match, response, learn
-
-    def __response_on_topic(self, session, text, previous_text, text_correction, current_topic):
-        match = self.__intend_selection(text, previous_text, current_topic) or \
-                self.__intend_selection(text_correction, previous_text, current_topic)
+    @staticmethod
+    def __intend_selection(text, previous_text, history, matchers, metrics=None):
+        for matcher in matchers:
+            match = matcher.match(text, previous_text, history, metrics)
+            if match:
+                return match
+        return None
+
+    def __response_on_topic(self, session, context, text, previous_text, history, texts, current_topic,
+                            use_defaults=True):
+        learned = self.__learned(session)
+        # learned blocks come first
+        matchers = [matcher for matcher in (None if learned is None else learned.matcher(current_topic),
+                                            self._matchers.get(current_topic)) if matcher is not None]
+        metrics = session.metrics
+        start = None if metrics is None else perf_counter()
+        match = None
+        for candidate in texts:
+            match = self.__intend_selection(candidate, previous_text, history, matchers, metrics)
+            if match:
+                break
+        if metrics is not None:
+            metrics.add("intent_selection", perf_counter() - start)
         if match:
             match, parent_match, response, learn = match
             if learn:
-                self.__process_learn({
-                    self._wildcards(session, (topic, self._condition(topic)), match, parent_match):
-                        {
-                            'pairs': [self.__substitute_in_learn(session, pair, match, parent_match)
-                                      for pair in learn[topic]['pairs']],
-                            'defaults': [
-                                self._wildcards(session, (default, self._condition(default)), match, parent_match)
-                                for default in learn[topic]['defaults']]}
-                    for topic in learn
-                })
-            return self.__chose_and_process(session, response, match, parent_match)
-        if self._pairs[current_topic]["defaults"]:
-            return self.__chose_and_process(session, self._pairs[current_topic]["defaults"], DummyMatch(text), None)
+                learned = {}
+                for topic in learn:
+                    name = yield from self.__wildcards(session, (topic, self._condition(topic)), match, parent_match,
+                                                       context)
+                    learned[name] = {'pairs': [], 'defaults': []}
+                    for pair in learn[topic]['pairs']:
+                        learned[name]['pairs'].append(
+                            (yield from self.__substitute_in_learn(session, pair, match, parent_match, context)))
+                    for default in learn[topic]['defaults']:
+                        learned[name]['defaults'].append((yield from self.__wildcards(
+                            session, (default, self._condition(default)), match, parent_match, context)))
+                self.__learned(session, create=True).learn(self.__compile_pairs(learned))
+            return (yield from self.__chose_and_process(session, response, match, parent_match, context))
+        defaults = self.__defaults(session, current_topic)
+        if use_defaults and defaults:
+            return (yield from self.__chose_and_process(session, defaults, DummyMatch(text), None, context))
         raise ValueError("No match found")
 
-    def _respond(self, session, text):
-        text = self.__normalize(text)
+    def __defaults(self, session, topic):
+        defaults = self._pairs[topic]["defaults"] if topic in self._pairs else []
+        learned = self.__learned(session)
+        if learned is not None and learned.defaults(topic):
+            defaults = defaults + learned.defaults(topic)
+        return defaults
+
+    @staticmethod
+    def __topic_chain(current_topic):
+        current_topic_order = current_topic.split(".")
+        topics = []
+        while current_topic_order:
+            topics.append(".".join(current_topic_order))
+            current_topic_order.pop()
+        if topics[-1]:
+            topics.append("")
+        return topics
+
+    def __spell_correction(self, text):
+        text_correction = self.spell_checker.correction(text)
+        return () if text_correction == text else (text_correction,)
+
+    def __respond(self, session, text, context=None):
+        text = timed(session.metrics, "normalize", self.__normalize, text)
+        return (yield from self.__respond_normalized(session, text, context))
+
+    def __respond_normalized(self, session, text, context=None, skip_user=0):
+        # the topic depth of the reply, not of the chat tags in it
+        metrics = session.metrics if context is None else None
+        if context is None:
+            context = self.__context(session)
+        conversation = session.conversation
+        # normalized when they were added to the conversation
         try:
-            previous_text = self.__normalize(session.conversation.get_bot_message(-1))
+            previous_text = conversation.get_bot_message(-1, normalized=True)
         except IndexError:
             previous_text = ""
-        text_correction = self.spell_checker.correction(text)
-        current_topic = session.topic
-        current_topic_order = current_topic.split(".")
-        while current_topic_order:
+
+        def history(bot, depth):
+            return conversation.previous(bot, depth, 0 if bot else skip_user)
+
+        topics = self.__topic_chain(session.topic)
+        if self.spell_correction == "eager":
+            texts = (text,) + timed(session.metrics, "spell_correction", self.__spell_correction, text)
+        elif self.spell_correction == "fallback":
+            # correction is costly for unknown words, so only pay for it once the raw
+            # message has missed in every topic up to the first one with default responses,
+            # the corrected message is then tried in the same topics before those defaults
+            for depth, current_topic in enumerate(topics):
+                try:
+                    response = yield from self.__response_on_topic(session, context, text, previous_text, history,
+                                                                   (text,), current_topic, use_defaults=False)
+                except ValueError:
+                    if self.__defaults(session, current_topic):
+                        topics = topics[:depth + 1]
+                        break
+                    continue
+                if metrics is not None:
+                    metrics.topic_depth = depth
+                return response
+            texts = timed(session.metrics, "spell_correction", self.__spell_correction, text)
+        else:
+            texts = (text,)
+        for depth, current_topic in enumerate(topics):
             try:
-                return self.__response_on_topic(session, text, previous_text, text_correction, current_topic)
+                response = yield from self.__response_on_topic(session, context, text, previous_text, history,
+                                                               texts, current_topic)
             except ValueError:
-                pass
-            current_topic_order.pop()
-            current_topic = ".".join(current_topic_order)
-        try:
-            return self.__response_on_topic(session, text, previous_text, text_correction, current_topic)
-        except ValueError:
-            return "Sorry I couldn't find anything relevant"
+                continue
+            if metrics is not None:
+                metrics.topic_depth = depth
+            return response
+        return "Sorry I couldn't find anything relevant"
 
-    def __substitute_in_learn(self, session, pair, match, parent_match):
-        return tuple((self.__substitute_in_learn(session, i, match, parent_match)
-                      if isinstance(i, (tuple, list)) else
-                      (i if isinstance(i, dict) else (
-                          self._wildcards(session, (i, self._condition(i)), match,
-                                          parent_match) if i else i))) for i in pair)
+    def _respond(self, session, text):
+        return run(self.__respond(session, text))
+
+    def __substitute_in_learn(self, session, pair, match, parent_match, context):
+        substituted = []
+        for i in pair:
+            if isinstance(i, tuple) and len(i) == 3 and isinstance(i[2], int):
+                # (pattern, speaker, depth) of a prev tag, only the pattern is a template
+                pattern = yield from self.__wildcards(session, (i[0], self._condition(i[0])), match, parent_match,
+                                                      context)
+                i = (pattern,) + i[1:]
+            elif isinstance(i, (tuple, list)):
+                i = yield from self.__substitute_in_learn(session, i, match, parent_match, context)
+            elif not isinstance(i, dict) and i:
+                i = yield from self.__wildcards(session, (i, self._condition(i)), match, parent_match, context)
+            substituted.append(i)
+        return tuple(substituted)
 
     @staticmethod
     def __get_topic_recursion(topics):
@@ -902,9 +1264,22 @@ class Chat(object):
         return result
 
     def save_template(self, filename):
+        """
+        Write the blocks of the template, with the ones learned by every session ahead of them
+        when learning is global.
+
+        :type filename: str
+        """
+        pairs = self._pairs
+        if self._learned is not None and len(self._learned):
+            pairs = {topic: dict(group) for topic, group in pairs.items()}
+            for topic, group in self._learned.groups().items():
+                saved = pairs.setdefault(topic, {"pairs": [], "defaults": []})
+                saved["pairs"] = group["pairs"] + saved["pairs"]
+                saved["defaults"] = saved["defaults"] + group["defaults"]
         with open(filename, "w") as template:
-            for topic_name, sub_topic in self.__get_topic_recursion(self._pairs).items():
-                self.__generate_and_write_template(template, self._pairs, topic_name, sub_topic)
+            for topic_name, sub_topic in self.__get_topic_recursion(pairs).items():
+                self.__generate_and_write_template(template, pairs, topic_name, sub_topic)
 
     def __generate_and_write_template(self, template, pairs, topic, sub_topics, base_path=None, padding=""):
         full_path = (base_path + "." + topic) if base_path else topic
@@ -916,16 +1291,29 @@ class Chat(object):
         for topic_name, sub_topic in sub_topics.items():
             self.__generate_and_write_template(template, pairs, topic_name, sub_topic, full_path,
                                                padding=new_padding + "\t")
-        for (patterns, parents, response, learn) in pairs[full_path]["pairs"]:
+        # topics only holding other topics have no group of their own
+        group = pairs.get(full_path, {"pairs": (), "defaults": ()})
+        for (patterns, parents, response, learn) in group["pairs"]:
             template.write(new_padding + "{% block %}\n")
             if parents is None:
                 parents = []
+            # the blocks of learn tags are kept as written, not compiled
             for parent in parents:
-                template.write(new_padding + "\t{% prev %}" + parent.pattern + "{% endprev %}\n")
+                if isinstance(parent, PreviousPattern):
+                    template.write("%s\t{%% prev %s %d %%}%s{%% endprev %%}\n" % (
+                        new_padding, "bot" if parent.bot else "user", parent.depth, parent.pattern.pattern))
+                elif isinstance(parent, (tuple, list)):
+                    template.write("%s\t{%% prev %s %d %%}%s{%% endprev %%}\n" % (
+                        new_padding, parent[1], parent[2], parent[0]))
+                else:
+                    parent = getattr(parent, "pattern", parent)
+                    template.write(new_padding + "\t{% prev %}" + parent + "{% endprev %}\n")
             for pattern in patterns:
-                template.write(new_padding + "\t{% client %}" + pattern.pattern + "{% endclient %}\n")
+                pattern = getattr(pattern, "pattern", pattern)
+                template.write(new_padding + "\t{% client %}" + pattern + "{% endclient %}\n")
             for res in response:
-                template.write(new_padding + "\t{% response %}" + res[0] + "{% response %}\n")
+                template.write(new_padding + "\t{% response %}" + (res if isinstance(res, str) else res[0])
+                               + "{% endresponse %}\n")
             if learn:
                 template.write(new_padding + "\t{% learn %}\n")
                 for topic_name, sub_topic in self.__get_topic_recursion(learn).items():
@@ -933,17 +1321,66 @@ class Chat(object):
                                                        padding=new_padding + "\t")
                 template.write(new_padding + "\t{% endlearn %}\n")
             template.write(new_padding + "{% endblock %}\n")
-        for res in pairs[topic]["defaults"]:
-            template.write(new_padding + "{% response %}" + res[0] + "{% response %}\n")
+        for res in group["defaults"]:
+            template.write(new_padding + "{% response %}" + (res if isinstance(res, str) else res[0])
+                           + "{% endresponse %}\n")
         if topic:
             template.write(padding + "{% endgroup %}\n")
 
-    def _say(self, session, message):
-        session.conversation.append_user_message(message)
-        response = self._respond(session, message.rstrip("!."))
+    def __say(self, session, message):
+        # normalized once, for the reply and for the prev patterns of the next messages
+        text = timed(session.metrics, "normalize", self.__normalize, message.rstrip("!."))
+        session.conversation.append_user_message(message, text)
+        response = yield from self.__respond_normalized(session, text, skip_user=1)
         session.conversation.append_bot_message(response)
         return response
 
+    def _say(self, session, message):
+        return run(self.__say(session, message))
+
+    def __metrics(self, session_id, message):
+        return MessageMetrics(session_id, message, self.cache_info) if self._instrumented else None
+
+    def __report(self, metrics):
+        metrics.finish()
+        if self._slow_messages is not None:
+            self._slow_messages(metrics)
+        if self._on_message is not None:
+            self._on_message(metrics)
+
+    def cache_info(self):
+        """
+        Hits, misses and size of the spell correction cache and of the api methods with a cache.
+
+        :rtype: dict
+        :return: {"spell_checker" or "<api>:<method>": CacheInfo}
+        """
+        caches = {"spell_checker": self.spell_checker.cache_info()}
+        for api_name, methods in self._api.api.items():
+            for method_name, method in methods.items():
+                if isinstance(method, dict) and "cache" in method:
+                    caches["%s:%s" % (api_name, method_name)] = self._api.cache_info(api_name, method_name)
+        return caches
+
+    def _session_lock(self, session_id, asynchronous=False):
+        """
+        Lock serializing the messages of one session, replies of different sessions run concurrently.
+        A session should be served either through say/respond or through asay/arespond.
+
+        :type session_id: str
+        :param session_id: Current User session
+        :type asynchronous: bool
+        :param asynchronous: asyncio.Lock for asay/arespond instead of a threading.RLock
+        """
+        key = (session_id, asynchronous)
+        lock = self._session_locks.get(key)
+        if lock is None:
+            with self._session_locks_lock:
+                lock = self._session_locks.get(key)
+                if lock is None:
+                    lock = self._session_locks[key] = asyncio.Lock() if asynchronous else threading.RLock()
+        return lock
+
     def respond(self, message, session_id="general"):
         """
         Generate a response to the user input.
@@ -954,7 +1391,15 @@ class Chat(object):
         :param session_id: Current User session when used for multi user scenario
         :rtype: str
         """
-        return self._respond(mapper.Session(self, session_id), message)
+        with self._session_lock(session_id):
+            self._use_session(session_id)
+            session = mapper.Session(self, session_id, self.__metrics(session_id, message))
+            response = self._respond(session, message)
+            if self._backend is not None:
+                self._save_session(session_id)
+        if session.metrics is not None:
+            self.__report(session.metrics)
+        return response
 
     def say(self, message, session_id="general"):
         """
@@ -965,7 +1410,76 @@ class Chat(object):
         :param session_id: Current User session when used for multi user scenario
         :rtype: str
         """
-        return self._say(mapper.Session(self, session_id), message)
+        with self._session_lock(session_id):
+            self._use_session(session_id)
+            session = mapper.Session(self, session_id, self.__metrics(session_id, message))
+            response = self._say(session, message)
+            if self._backend is not None:
+                self._save_session(session_id)
+        if session.metrics is not None:
+            self.__report(session.metrics)
+        return response
+
+    async def arespond(self, message, session_id="general"):
+        """
+        Generate a response to the user input without blocking the event loop.
+        Coroutine functions registered with register_call are awaited and api calls
+        run in the default executor of the loop.
+
+        :type message: str
+        :param message: The string to be mapped
+        :type session_id: str
+        :param session_id: Current User session when used for multi user scenario
+        :rtype: str
+        """
+        async with self._session_lock(session_id, asynchronous=True):
+            self._use_session(session_id)
+            session = mapper.Session(self, session_id, self.__metrics(session_id, message))
+            response = await arun(self.__respond(session, message))
+            if self._backend is not None:
+                self._save_session(session_id)
+        if session.metrics is not None:
+            self.__report(session.metrics)
+        return response
+
+    async def asay(self, message, session_id="general"):
+        """
+        asay is the asynchronous counterpart of say, see arespond
+        :type message: str
+        :param message: Client message
+        :type session_id: str
+        :param session_id: Current User session when used for multi user scenario
+        :rtype: str
+        """
+        async with self._session_lock(session_id, asynchronous=True):
+            self._use_session(session_id)
+            session = mapper.Session(self, session_id, self.__metrics(session_id, message))
+            response = await arun(self.__say(session, message))
+            if self._backend is not None:
+                self._save_session(session_id)
+        if session.metrics is not None:
+            self.__report(session.metrics)
+        return response
+
+    def say_many(self, messages, processes=None, chunk_size=256):
+        """
+        Reply to many (session_id, message) pairs using a pool of worker processes.
+
+        Each worker builds a Chat from the arguments this one was created with, so pairs learned
+        and session state kept by this instance are not seen by the workers and the state built up
+        by the workers is not copied back. All the messages of a session go to the same worker in
+        input order and unknown sessions are started on their first message.
+
+        :type messages: iterable of tuple
+        :param messages: (session_id, message) pairs
+        :type processes: int
+        :param processes: number of worker processes, None for the number of CPUs
+        :type chunk_size: int
+        :param chunk_size: messages sent to a worker at once
+        :rtype: generator of str
+        :return: the replies, in input order
+        """
+        return batch.say_many(type(self), (), self._arguments, messages, processes, chunk_size)
 
     @staticmethod
     def terminal_chat(callback, first_question, terminate):
@@ -1008,6 +1522,7 @@ class Chat(object):
         :rtype: str
         """
 
+        self._use_session(session_id)
         session = mapper.Session(self, session_id)
         if first_question:
             session.conversation.append_bot_message(first_question)
@@ -1022,7 +1537,8 @@ class Chat(object):
                     raise ImportError('tkinter is missing. Please install tkinter.')
                 chat_handler = self.terminal_chat
 
-        chat_handler(partial(self._say, session), first_question, terminate)
+        # say finds the session again for every message, it may be evicted in between
+        chat_handler(partial(self.say, session_id=session_id), first_question, terminate)
 
 
 def demo(first_question=None, language="en", gui=None, **kwargs):
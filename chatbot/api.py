@@ -0,0 +1,288 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .singleflight import SingleFlight
+
+HTTP_METHODS = ("get", "options", "head", "post", "put", "patch", "delete")
+COALESCED_METHODS = ("get", "options", "head")
+CONNECTION = "connection"
+DEFAULT_CONNECTION = {
+    "pool_size": 10,
+    "timeout": None,
+    "retries": 0,
+    "backoff_factor": 0,
+    "retry_on_status": [],
+}
+AUTH_TTL = 300
+AUTH_FAILURE_STATUS = (401, 403)
+CACHE_MAX_ENTRIES = 128
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+class ResponseCache:
+    """
+    Least recently used cache of API results, each expiring `ttl` seconds after it was stored.
+    """
+
+    def __init__(self, ttl, max_entries=CACHE_MAX_ENTRIES):
+        if ttl <= 0 or max_entries < 1:
+            raise ValueError("cache ttl and max_entries should be positive")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """
+        :rtype: tuple
+        :return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.max_entries, len(self._entries))
+
+
+class ApiClient:
+    """
+    Perform the requests of the APIs defined in api.json.
+
+    Every API gets its own `requests.Session`, so connections (and TLS
+    sessions) are kept alive and reused between calls. The optional
+    "connection" entry of an API configures its session:
+
+        "connection": {
+            "pool_size": 10,             # connections kept alive per host
+            "timeout": 5,                # seconds, or [connect, read], null to wait forever
+            "retries": 3,                # retries of failed connections and retry_on_status
+            "backoff_factor": 0.5,       # sleep backoff_factor * 2 ** (retry - 1) between retries
+            "retry_on_status": [502, 503, 504]
+        }
+
+    The cookies returned by the "auth" request of an API are reused for
+    "ttl" seconds (an entry of "auth", 300 by default, 0 to log in before
+    every call). They are refreshed once expired or when a call answers
+    401 or 403, and concurrent callers wait for a single refresh.
+
+    A method with a "cache" entry ({"ttl": 60, "max_entries": 128}) reuses
+    the value of successful calls with the same params/data for ttl seconds.
+    The value is stored after the value_getter picked it from the response.
+
+    Concurrent calls of a method with the same params/data share one request
+    and its result. This is the default for GET, HEAD and OPTIONS methods and
+    can be turned on or off with the "coalesce" entry (true/false) of a method.
+    """
+
+    def __init__(self, api):
+        """
+        :type api: dict
+        :param api: API definitions, as loaded from api.json
+        """
+        self.api = api
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._auth = {}
+        self._auth_locks = {}
+        self._caches = {}
+        self._flight = SingleFlight()
+
+    def connection(self, api_name):
+        """
+        Connection settings of an API, with the defaults filled in.
+        """
+        connection = dict(DEFAULT_CONNECTION)
+        connection.update(self.api[api_name].get(CONNECTION, {}))
+        unknown = set(connection) - set(DEFAULT_CONNECTION)
+        if unknown:
+            raise ValueError("In api.json unknown '%s' settings for '%s': %s" % (
+                CONNECTION, api_name, ", ".join(sorted(unknown))))
+        return connection
+
+    def session(self, api_name):
+        """
+        Pooled HTTP session of an API, created on first use.
+
+        :rtype: requests.Session
+        """
+        try:
+            return self._sessions[api_name]
+        except KeyError:
+            pass
+        with self._lock:
+            if api_name not in self._sessions:
+                connection = self.connection(api_name)
+                retry = Retry(total=connection["retries"], backoff_factor=connection["backoff_factor"],
+                              status_forcelist=connection["retry_on_status"], raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=connection["pool_size"],
+                                      pool_maxsize=connection["pool_size"], max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[api_name] = session
+            return self._sessions[api_name]
+
+    def authenticate(self, api_name, stale=None):
+        """
+        Log in to an API, or reuse the cookies of a previous log in.
+
+        :type api_name: str
+        :param api_name: API with an "auth" entry
+        :type stale: tuple
+        :param stale: log in that was rejected, replaced even before it expires
+        :rtype: tuple
+        :return: (cookies, expiry time)
+        """
+        entry = self._auth.get(api_name)
+        if entry is not None and entry is not stale and entry[1] > time.monotonic():
+            return entry
+        with self._lock:
+            lock = self._auth_locks.setdefault(api_name, threading.Lock())
+        with lock:
+            # somebody else may have logged in while this thread was waiting
+            entry = self._auth.get(api_name)
+            if entry is not None and entry is not stale and entry[1] > time.monotonic():
+                return entry
+            auth = dict(self.api[api_name]["auth"])
+            ttl = auth.pop("ttl", AUTH_TTL)
+            try:
+                cookies = self._request(api_name, **auth).cookies
+            except TypeError:
+                raise ValueError("In api.json 'auth' of '%s' is wrongly configured." % api_name)
+            entry = (cookies, time.monotonic() + ttl)
+            if ttl > 0:
+                self._auth[api_name] = entry
+            return entry
+
+    def cache(self, api_name, method_name):
+        """
+        Result cache of a method, None when the method has no "cache" entry.
+
+        :rtype: ResponseCache
+        """
+        key = (api_name, method_name)
+        try:
+            return self._caches[key]
+        except KeyError:
+            pass
+        settings = self.api[api_name][method_name].get("cache")
+        if settings is None:
+            return None
+        with self._lock:
+            if key not in self._caches:
+                try:
+                    self._caches[key] = ResponseCache(**settings)
+                except TypeError:
+                    raise ValueError("In api.json 'cache' of '%s:%s' is wrongly configured." % key)
+            return self._caches[key]
+
+    def cache_info(self, api_name, method_name):
+        """
+        Hits, misses, evictions and size of the result cache of a method.
+
+        :rtype: CacheInfo
+        """
+        cache = self.cache(api_name, method_name)
+        return None if cache is None else cache.info()
+
+    def close(self):
+        """
+        Close the connections kept alive, sessions are created again when needed.
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+            self._auth.clear()
+        for session in sessions.values():
+            session.close()
+
+    def _request(self, api_name, url, method, **kwargs):
+        if method.lower().strip() not in HTTP_METHODS:
+            raise RuntimeError("Invalid method name '%s' in api.json" % method)
+        if "timeout" not in kwargs:
+            timeout = self.connection(api_name)["timeout"]
+            kwargs["timeout"] = tuple(timeout) if isinstance(timeout, list) else timeout
+        try:
+            return self.session(api_name).request(method.upper().strip(), url, **kwargs)
+        except requests.exceptions.MissingSchema:
+            return self._request(api_name, "http://" + url, method, **kwargs)
+        except requests.exceptions.ConnectionError:
+            raise RuntimeError("Couldn't connect to server (unreachable). Check your network")
+        except requests.exceptions.Timeout:
+            raise RuntimeError("No response from '%s' within the timeout" % url)
+
+    def request(self, api_name, method_name, data=None):
+        """
+        Call a method of an API.
+
+        :type api_name: str
+        :param api_name: API name in api.json
+        :type method_name: str
+        :param method_name: method name of the API
+        :type data: dict
+        :param data: values overriding the default params (GET) or data (other methods) of the method
+        :return: response content, json decoded and picked with value_getter for json APIs
+        """
+        if api_name not in self.api or method_name not in self.api[api_name] or method_name == CONNECTION:
+            raise RuntimeError("Invalid method name '%s' for api '%s' ", (method_name, api_name))
+        api_params = dict(self.api[api_name][method_name])
+        if method_name == "auth":
+            api_params.pop("ttl", None)
+        param = "params" if api_params["method"].upper().strip() == "GET" else "data"
+        # copy the defaults, they are shared by every call of the method
+        api_params[param] = dict(api_params.get(param) or {})
+        api_params[param].update(data or {})
+        key = (api_name, method_name, json.dumps(api_params[param], sort_keys=True, default=str))
+        cache = self.cache(api_name, method_name)
+        if cache is not None:
+            found, value = cache.get(key)
+            if found:
+                return value
+        if api_params.pop("coalesce", api_params["method"].lower().strip() in COALESCED_METHODS):
+            return self._flight.do(key, self._call, api_name, api_params, cache, key)
+        return self._call(api_name, api_params, cache, key)
+
+    def _call(self, api_name, api_params, cache, key):
+        api_type = api_params.pop("type", "normal")
+        api_data_getter = api_params.pop("value_getter", [])
+        api_params.pop("cache", None)
+        auth = None
+        if "auth" in self.api[api_name]:
+            auth = self.authenticate(api_name)
+            api_params["cookies"] = auth[0]
+        response = self._request(api_name, **api_params)
+        if auth is not None and response.status_code in AUTH_FAILURE_STATUS and api_name in self._auth:
+            api_params["cookies"] = self.authenticate(api_name, stale=auth)[0]
+            response = self._request(api_name, **api_params)
+        response_text = response.json() if api_type.upper().strip() == "JSON" else response.content
+        for getter in api_data_getter:
+            response_text = response_text[getter]
+        if cache is not None and response.ok:
+            cache.set(key, response_text)
+        return response_text
@@ -0,0 +1,156 @@
+import abc
+import atexit
+import json
+import sqlite3
+import threading
+
+
+class SessionBackend(abc.ABC):
+    """
+    Storage of the session state (memory, conversation, attributes and topic) outliving the process.
+
+    Sessions are loaded the first time they are used and saved after every message,
+    as dicts of json serializable values. Subclasses implement load and save.
+    """
+
+    @abc.abstractmethod
+    def load(self, session_id):
+        """
+        :type session_id: str
+        :rtype: dict
+        :return: state saved for the session, None for an unknown session
+        """
+
+    @abc.abstractmethod
+    def save(self, session_id, state):
+        """
+        :type session_id: str
+        :type state: dict
+        :param state: state of the session, the backend doesn't keep a reference to it
+        """
+
+    def flush(self):
+        """
+        Write the saved states not written yet.
+        """
+
+    def close(self):
+        self.flush()
+
+    def reopen(self):
+        """
+        Backend over the same storage for a new process. Forked processes start with a copy of
+        this backend, sharing its connections with the parent, they use the one returned instead.
+
+        :rtype: SessionBackend
+        """
+        return self
+
+
+class SQLiteBackend(SessionBackend):
+    """
+    Session states kept in a SQLite database.
+
+    Saved states are written behind, in one transaction every `interval` seconds,
+    so a message never waits for the disk. Up to `interval` seconds of changes are
+    lost if the process is killed, they are written on a normal exit.
+    """
+
+    def __init__(self, file_name, interval=1.0):
+        """
+        :type file_name: str
+        :param file_name: database file, created if missing
+        :type interval: float
+        :param interval: seconds between two writes
+        """
+        self.file_name = file_name
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._dirty = {}
+        self._wake = threading.Event()
+        self._writer = None
+        self._closed = False
+        self._connection = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, state TEXT)")
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        # every process opens its own connection
+        return {"file_name": self.file_name, "interval": self.interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def reopen(self):
+        # the connection and the pending states of the copy belong to the parent
+        return SQLiteBackend(self.file_name, self.interval)
+
+    def load(self, session_id):
+        with self._lock:
+            state = self._dirty.get(session_id)
+        if state is None:
+            with self._db_lock:
+                row = self._connection.execute("SELECT state FROM sessions WHERE session_id = ?",
+                                               (session_id,)).fetchone()
+            if row is None:
+                return None
+            state = row[0]
+        return json.loads(state)
+
+    def save(self, session_id, state):
+        state = json.dumps(state)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("save on a closed backend")
+            self._dirty[session_id] = state
+            if self._writer is None:
+                self._writer = threading.Thread(target=self.__write_behind, name="chatbot-sqlite", daemon=True)
+                self._writer.start()
+
+    def __write_behind(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # the states are kept and written with the next batch
+                pass
+
+    def flush(self):
+        with self._db_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            try:
+                self._connection.execute("BEGIN")
+                self._connection.executemany("INSERT OR REPLACE INTO sessions (session_id, state) VALUES (?, ?)",
+                                             dirty.items())
+                self._connection.execute("COMMIT")
+            except sqlite3.Error:
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+                with self._lock:
+                    # keep the states saved again in the meantime
+                    dirty.update(self._dirty)
+                    self._dirty = dirty
+                raise
+
+    def close(self):
+        """
+        Write the pending states and close the database, the backend can't be used afterwards.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake.set()
+        if self._writer is not None and self._writer is not threading.current_thread():
+            self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._connection.close()
+        atexit.unregister(self.close)
@@ -0,0 +1,112 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from zlib import crc32
+
+_chat = None
+
+
+def _start_worker(chat_class, args, kwargs):
+    global _chat
+    backend = kwargs.get("backend")
+    if backend is not None:
+        # a forked worker holds a copy of the backend of the parent, open its own one
+        kwargs = dict(kwargs, backend=backend.reopen())
+    _chat = chat_class(*args, **kwargs)
+
+
+def _say_chunk(chunk):
+    replies = []
+    for session_id, message in chunk:
+        replies.append(_chat.say(message, session_id=session_id))
+    if _chat._backend is not None:
+        # exit handlers don't run in pool workers
+        _chat._backend.flush()
+    return replies
+
+
+def _stop_worker():
+    if _chat._backend is not None:
+        _chat._backend.close()
+
+
+def shard(session_id, processes):
+    """
+    Worker handling every message of a session.
+    """
+    return crc32(str(session_id).encode("utf-8")) % processes
+
+
+def say_many(chat_class, args, kwargs, messages, processes=None, chunk_size=256):
+    """
+    Reply to (session_id, message) pairs on a pool of worker processes.
+
+    Every worker builds its own Chat from the given arguments and all the
+    messages of a session are handled by the same worker, in input order.
+    Workers open their own session backend (see SessionBackend.reopen) and
+    write the sessions they changed after every chunk.
+    Replies are yielded in input order while the input is still being read.
+
+    :type chat_class: type
+    :param chat_class: Chat or a subclass of it
+    :type args: tuple
+    :param args: positional arguments the workers build their Chat with
+    :type kwargs: dict
+    :param kwargs: keyword arguments the workers build their Chat with
+    :type messages: iterable of tuple
+    :param messages: (session_id, message) pairs
+    :type processes: int
+    :param processes: number of worker processes, None for the number of CPUs
+    :type chunk_size: int
+    :param chunk_size: messages sent to a worker at once
+    :rtype: generator of str
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes < 1 or chunk_size < 1:
+        raise ValueError("processes and chunk_size should be at least 1")
+    return _replies(chat_class, args, kwargs, messages, processes, chunk_size)
+
+
+def _replies(chat_class, args, kwargs, messages, processes, chunk_size):
+    # one single process pool per shard, so the chunks of a shard are handled in order
+    executors = [ProcessPoolExecutor(1, initializer=_start_worker, initargs=(chat_class, args, kwargs))
+                 for _ in range(processes)]
+    pending = [[] for _ in range(processes)]
+    submitted = [deque() for _ in range(processes)]
+    replies = [deque() for _ in range(processes)]
+    order = deque()
+
+    def submit(index):
+        submitted[index].append(executors[index].submit(_say_chunk, pending[index]))
+        pending[index] = []
+
+    def next_reply():
+        index = order.popleft()
+        if not replies[index]:
+            if not submitted[index]:
+                submit(index)
+            replies[index].extend(submitted[index].popleft().result())
+        return replies[index].popleft()
+
+    try:
+        for session_id, message in messages:
+            index = shard(session_id, processes)
+            pending[index].append((session_id, message))
+            order.append(index)
+            if len(pending[index]) >= chunk_size:
+                submit(index)
+            # bound the replies held in memory when the input is much larger than the pool
+            while len(order) > processes * chunk_size * 4:
+                yield next_reply()
+        for index in range(processes):
+            if pending[index]:
+                submit(index)
+        while order:
+            yield next_reply()
+    finally:
+        for futures in submitted:
+            for future in futures:
+                future.cancel()
+        for executor in executors:
+            executor.submit(_stop_worker)
+            executor.shutdown(wait=True)
@@ -0,0 +1,161 @@
+import asyncio
+import inspect
+from functools import partial
+
+
+class Effect:
+    """
+    Operation a response generator yields to its driver instead of running it.
+
+    The generator is resumed with the result of the operation, or with the
+    exception it raised, so the template semantics are written once and run
+    both by the blocking driver (`run`) and on an event loop (`arun`).
+    """
+    __slots__ = ("function", "args")
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def run(self):
+        return self.function(*self.args)
+
+    async def arun(self):
+        result = self.function(*self.args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
+class BlockingEffect(Effect):
+    """
+    Effect doing blocking I/O, run in the default executor of the event loop by `arun`.
+    """
+    __slots__ = ()
+
+    async def arun(self):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(self.function, *self.args))
+
+
+class CallEffect(Effect):
+    """
+    Call through a MultiFunctionCall, the registered function may be a coroutine function in `arun`.
+    """
+    __slots__ = ()
+
+    def run(self):
+        return self.function.call(*self.args)
+
+    async def arun(self):
+        return await self.function.acall(*self.args)
+
+
+def _outcome(effect):
+    try:
+        return effect.run(), None
+    except Exception as e:
+        return None, e
+
+
+async def _aoutcome(effect):
+    try:
+        return await effect.arun(), None
+    except Exception as e:
+        return None, e
+
+
+class Parallel(Effect):
+    """
+    Independent effects run side by side, resolving to the list of their (value, error) outcomes.
+
+    `run` keeps the first effect in the calling thread and submits the others to
+    the executor, `arun` gathers them on the event loop.
+    """
+    __slots__ = ()
+
+    def __init__(self, executor, effects):
+        super().__init__(executor, *effects)
+
+    def run(self):
+        futures = [self.function.submit(_outcome, effect) for effect in self.args[1:]]
+        return [_outcome(self.args[0])] + [future.result() for future in futures]
+
+    async def arun(self):
+        return list(await asyncio.gather(*(_aoutcome(effect) for effect in self.args)))
+
+
+def gather(executor, steps):
+    """
+    Drive response generators side by side, the effects they yield at the same step run as one Parallel effect.
+
+    :type executor: concurrent.futures.Executor
+    :param executor: executor running the effects of `run`
+    :type steps: list of generator
+    :param steps: generators yielding Effect objects
+    :rtype: list of tuple
+    :return: (value returned, exception raised) of each generator, in order
+    """
+    outcomes = [None] * len(steps)
+    sent = [(index, None, None) for index in range(len(steps))]
+    while sent:
+        effects = []
+        for index, value, error in sent:
+            try:
+                effect = steps[index].send(value) if error is None else steps[index].throw(error)
+            except StopIteration as stop:
+                outcomes[index] = (stop.value, None)
+            except Exception as e:
+                outcomes[index] = (None, e)
+            else:
+                effects.append((index, effect))
+        if len(effects) == 1:
+            try:
+                results = [((yield effects[0][1]), None)]
+            except Exception as e:
+                results = [(None, e)]
+        elif effects:
+            results = yield Parallel(executor, [effect for _, effect in effects])
+        else:
+            results = []
+        sent = [(index, value, error) for (index, _), (value, error) in zip(effects, results)]
+    return outcomes
+
+
+def run(steps):
+    """
+    Drive a response generator to its result, running the effects it yields in place.
+
+    :type steps: generator
+    :param steps: generator yielding Effect objects
+    :return: value returned by the generator
+    """
+    value = error = None
+    while True:
+        try:
+            effect = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = effect.run(), None
+        except Exception as e:
+            value, error = None, e
+
+
+async def arun(steps):
+    """
+    Drive a response generator to its result, awaiting the effects it yields.
+
+    :type steps: generator
+    :param steps: generator yielding Effect objects
+    :return: value returned by the generator
+    """
+    value = error = None
+    while True:
+        try:
+            effect = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = await effect.arun(), None
+        except Exception as e:
+            value, error = None, e
@@ -0,0 +1,165 @@
+import threading
+import weakref
+from collections import OrderedDict
+from .matcher import IntentMatcher, PreviousPattern, required_literals
+
+DEFAULT_CAPACITY = 1000
+
+
+def _pattern_key(pattern):
+    if isinstance(pattern, PreviousPattern):
+        return pattern.pattern.pattern, pattern.bot, pattern.depth
+    return pattern.pattern
+
+
+class LearnedIntents:
+    """
+    Blocks and default responses taught by learn tags, kept apart from the template.
+
+    At most `capacity` blocks and defaults are kept, the least recently learned
+    are dropped first. A block learned again with the same client and prev
+    patterns replaces the previous one, and equal patterns share one compiled
+    regex. The literals required by the client patterns of a block are found
+    once, when it is first learned: blocks learned in a topic are added ahead
+    of the ones already in its matcher, and the matchers of the topics that
+    lost blocks are built again on their next use, without analysing the
+    patterns again. Replies being computed keep the matchers they started with.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("learned intents capacity should be at least 1 found %d" % capacity)
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # every block and default in learning order, the oldest are dropped first
+        self._entries = OrderedDict()
+        # {topic: (blocks, defaults)} with the (block, literals, batch) and default responses of every key
+        self._groups = {}
+        self._patterns = weakref.WeakValueDictionary()
+        self._topics = {}
+        self._matchers = {}
+        self._batches = 0
+
+    def __intern(self, pattern):
+        if isinstance(pattern, PreviousPattern):
+            return PreviousPattern(self.__intern(pattern.pattern), pattern.bot, pattern.depth)
+        return self._patterns.setdefault((pattern.pattern, pattern.flags), pattern)
+
+    def __drop(self, key):
+        """
+        Remove key from its topic, returning its entry or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            group = self._groups[key[0]]
+            del group[1 if len(key) == 2 else 0][key]
+            if not group[0] and not group[1]:
+                del self._groups[key[0]]
+        return entry
+
+    def learn(self, groups):
+        """
+        :type groups: dict
+        :param groups: compiled {topic: {"pairs": blocks, "defaults": responses}}, the blocks learned
+            together keep their order, ahead of the ones learned before
+        """
+        with self._lock:
+            self._batches += 1
+            added = {}
+            # topics whose matcher lost blocks
+            changed = set()
+            for topic, group in groups.items():
+                for block in group["pairs"]:
+                    patterns = tuple(self.__intern(pattern) for pattern in block[0])
+                    parents = None if block[1] is None else tuple(self.__intern(parent) for parent in block[1])
+                    key = (topic, tuple(_pattern_key(pattern) for pattern in patterns),
+                           None if parents is None else tuple(_pattern_key(parent) for parent in parents))
+                    previous = self.__drop(key)
+                    if previous is None:
+                        literals = tuple(required_literals(pattern) for pattern in patterns)
+                    else:
+                        # same client patterns
+                        literals = previous[1]
+                        changed.add(topic)
+                    entry = self._entries[key] = ((patterns, parents) + tuple(block[2:]), literals, self._batches)
+                    self._groups.setdefault(topic, (OrderedDict(), OrderedDict()))[0][key] = entry
+                    added.setdefault(topic, []).append(entry)
+                for default in group["defaults"]:
+                    key = (topic, default[0])
+                    self.__drop(key)
+                    self._entries[key] = default
+                    self._groups.setdefault(topic, (OrderedDict(), OrderedDict()))[1][key] = default
+                    added.setdefault(topic, [])
+            touched = set(added)
+            while len(self._entries) > self.capacity:
+                key = next(iter(self._entries))
+                self.__drop(key)
+                touched.add(key[0])
+                if len(key) != 2:
+                    changed.add(key[0])
+            topics = dict(self._topics)
+            matchers = dict(self._matchers)
+            for topic in touched:
+                if topic not in self._groups:
+                    topics.pop(topic, None)
+                    matchers.pop(topic, None)
+                    continue
+                blocks, defaults = self._groups[topic]
+                # most recently learned batch first, stable sort keeps the order inside a batch
+                entries = sorted(blocks.values(), key=lambda entry: -entry[2])
+                topics[topic] = ([entry[0] for entry in entries], [entry[1] for entry in entries],
+                                 list(defaults.values()))
+                matcher = matchers.pop(topic, None)
+                if topic in changed or matcher is None:
+                    # built on its next use
+                    continue
+                entries = added.get(topic)
+                if entries:
+                    matcher = matcher.copy()
+                    matcher.prepend([entry[0] for entry in entries], [entry[1] for entry in entries])
+                matchers[topic] = matcher
+            self._topics = topics
+            self._matchers = matchers
+
+    def __contains__(self, topic):
+        return topic in self._topics
+
+    def __len__(self):
+        return len(self._entries)
+
+    def matcher(self, topic):
+        """
+        :rtype: IntentMatcher
+        :return: matcher of the blocks learned for the topic, None when there are none
+        """
+        matchers = self._matchers
+        try:
+            return matchers[topic]
+        except KeyError:
+            pass
+        blocks, literals, _ = self._topics.get(topic, ((), (), ()))
+        matcher = None
+        if blocks:
+            matcher = IntentMatcher()
+            matcher.prepend(blocks, literals)
+        with self._lock:
+            # unless something was learned in the meantime
+            if matchers is self._matchers:
+                matchers = dict(matchers)
+                matchers[topic] = matcher
+                self._matchers = matchers
+        return matcher
+
+    def defaults(self, topic):
+        """
+        :rtype: list
+        :return: default responses learned for the topic, in the order they were learned
+        """
+        return self._topics.get(topic, ((), (), ()))[2]
+
+    def groups(self):
+        """
+        :rtype: dict
+        :return: {topic: {"pairs": blocks, most recently learned first, "defaults": responses}}
+        """
+        return {topic: {"pairs": blocks, "defaults": defaults} for topic, (blocks, _, defaults) in self._topics.items()}
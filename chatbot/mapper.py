@@ -1,67 +1,312 @@
+import threading
+import time
+from collections import OrderedDict
+from warnings import warn
+
+
+# attributes only meaningful while a message is answered, not saved
+TRANSIENT_ATTRIBUTES = ("match", "pmatch")
+
+
 class Session:
+    """
+    View of the state of one session of a Chat, with the metrics of the reply
+    being computed when the Chat collects them.
+    """
+    __slots__ = ("__chat", "session_id", "__state", "metrics")
 
-    def __init__(self, chat, session_id):
+    def __init__(self, chat, session_id, metrics=None):
         self.__chat = chat
         self.session_id = session_id
+        self.metrics = metrics
+        # looked up on first use when the session isn't started yet
+        self.__state = chat._states.get(session_id)
+
+    @property
+    def state(self):
+        if self.__state is None:
+            self.__state = self.__chat._states[self.session_id]
+        return self.__state
 
     @property
     def conversation(self):
-        return self.__chat._conversation[self.session_id]
+        return (self.__state or self.state).conversation
 
     @conversation.setter
     def conversation(self, value):
-        self.__chat._conversation[self.session_id] = value
+        """
+        :type value: Conversation or list
+        :param value: conversation, list of messages or of ("bot" or "user", message) pairs, see
+            `Conversation.from_messages`
+        """
+        state = self.state
+        depth, normalizer = state.conversation.depth, state.conversation.normalizer
+        if isinstance(value, Conversation):
+            state.conversation = Conversation(value, depth, normalizer)
+        else:
+            state.conversation = Conversation.from_messages(value, depth, normalizer)
 
     @property
     def memory(self):
-        return self.__chat._memory[self.session_id]
+        return (self.__state or self.state).memory
 
     @memory.setter
     def memory(self, value):
-        self.__chat._memory[self.session_id] = value
+        self.state.memory = dict(value)
 
     @property
     def attr(self):
-        return self.__chat._attr[self.session_id]
+        return (self.__state or self.state).attr
 
     @attr.setter
     def attr(self, value):
-        self.__chat._attr[self.session_id] = value
+        self.state.attr = dict(value)
 
     @property
     def topic(self):
-        return self.__chat._topic[self.session_id]
+        state = self.__state or self.state
+        if self.__chat._has_topic(state.topic, state):
+            return state.topic
+        return ''
 
     @topic.setter
     def topic(self, value):
-        self.__chat._topic[self.session_id] = value
-
-
-class Conversation(list):
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.__bot_message = []
-        self.__user_message = []
+        value = value.strip()
+        if value and value[0] == ".":
+            # relative to the current topic, every extra dot goes one level up
+            index = 1
+            current_topic = self.state.topic.split(".")
+            while value[index] == ".":
+                index += 1
+                current_topic.pop()
+            current_topic.append(value[index:])
+            value = ".".join(current_topic)
+        self.state.topic = value
+
+
+class SessionState:
+    """
+    Memory, attributes, topic and conversation of one session, and the blocks it
+    learned when they are learned per session (not saved by session backends).
+    """
+    __slots__ = ("memory", "attr", "topic", "conversation", "learned")
+
+    def __init__(self, memory=None, attr=None, topic='', conversation=None, learned=None):
+        self.memory = {} if memory is None else memory
+        self.attr = {} if attr is None else attr
+        self.topic = topic
+        self.conversation = Conversation() if conversation is None else conversation
+        self.learned = learned
+
+    def dump(self):
+        """
+        :rtype: dict
+        :return: json serializable copy of the state, as saved by session backends
+        """
+        return {"memory": self.memory, "conversation": self.conversation.state(), "topic": self.topic,
+                "attr": {key: value for key, value in self.attr.items() if key not in TRANSIENT_ATTRIBUTES}}
+
+    @classmethod
+    def load(cls, state, attr=None, depth=None, normalizer=None):
+        """
+        :type state: dict
+        :param state: state returned by dump
+        :type attr: dict
+        :param attr: default attributes, updated with the saved ones
+        :type depth: int
+        :param depth: messages kept in the conversation
+        :type normalizer: function
+        :param normalizer: normalizes the messages of the conversation
+        :rtype: SessionState
+        """
+        attr = dict(attr or {})
+        attr.update(state["attr"])
+        conversation = Conversation.from_state(state["conversation"], depth, normalizer)
+        return cls(state["memory"], attr, state["topic"], conversation)
+
+
+class Conversation:
+    """
+    Bot and user messages of a session, in the order they were said.
+
+    Only the last `depth` messages are kept, each stored once in a ring buffer
+    next to a flag telling who said it, so a session takes the same memory
+    however long its conversation. Indexes address the messages kept.
+
+    Messages are normalized once, when they are added, and their normalized
+    form (the message itself when normalizing doesn't change it) is kept for
+    matching prev patterns.
+    """
+    __slots__ = ("depth", "normalizer", "_messages", "_normalized", "_bot", "_start")
+
+    def __init__(self, conversation=(), depth=None, normalizer=None):
+        """
+        :type conversation: Conversation
+        :param conversation: conversation whose last `depth` messages are copied
+        :type depth: int
+        :param depth: messages kept, None to keep every message
+        :type normalizer: function
+        :param normalizer: normalizes the messages added, by default the one of the copied conversation
+        """
+        if depth is not None and depth < 1:
+            raise ValueError("conversation depth should be at least 1 found %d" % depth)
+        self.depth = depth
+        self.normalizer = normalizer
+        self._messages = []
+        self._normalized = []
+        self._bot = bytearray()
+        self._start = 0
+        if isinstance(conversation, Conversation):
+            if normalizer is None:
+                self.normalizer = conversation.normalizer
+            for position in conversation.__positions():
+                self.__append(conversation._messages[position], conversation._bot[position],
+                              conversation._normalized[position])
+        elif conversation:
+            raise TypeError("Conversation expected found %s" % type(conversation).__name__)
+
+    def __append(self, message, bot, normalized=None):
+        if normalized is None:
+            normalized = message if self.normalizer is None else self.normalizer(message)
+        if normalized == message:
+            normalized = message
+        if self.depth is None or len(self._messages) < self.depth:
+            self._messages.append(message)
+            self._normalized.append(normalized)
+            self._bot.append(bot)
+        else:
+            self._messages[self._start] = message
+            self._normalized[self._start] = normalized
+            self._bot[self._start] = bot
+            self._start = (self._start + 1) % self.depth
+
+    def append_bot_message(self, message, normalized=None):
+        """
+        :type message: str
+        :type normalized: str
+        :param normalized: normalized message, None to normalize it with the normalizer
+        """
+        self.__append(message, True, normalized)
+
+    def append_user_message(self, message, normalized=None):
+        self.__append(message, False, normalized)
 
-    def append_bot_message(self, message):
-        self.__bot_message.append(message)
-        self.append(message)
-
-    def append_user_message(self, message):
-        self.__user_message.append(message)
-        self.append(message)
+    def __len__(self):
+        return len(self._messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        size = len(self._messages)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("conversation index out of range")
+        return self._messages[(self._start + index) % size]
+
+    def __positions(self, reverse=False):
+        size = len(self._messages)
+        for index in (range(size - 1, -1, -1) if reverse else range(size)):
+            yield (self._start + index) % size
 
-    def get_bot_message(self, index):
-        return self.__bot_message[index]
+    def __iter__(self):
+        for position in self.__positions():
+            yield self._messages[position]
 
-    def get_user_message(self, index):
-        return self.__user_message[index]
+    def items(self):
+        """
+        :rtype: generator of tuple
+        :return: (said by the bot, message) pairs, from the oldest message kept
+        """
+        for position in self.__positions():
+            yield bool(self._bot[position]), self._messages[position]
+
+    def __get_message(self, index, bot, normalized):
+        messages = self._normalized if normalized else self._messages
+        count = -index if index < 0 else index + 1
+        for position in self.__positions(reverse=index < 0):
+            if self._bot[position] == bot:
+                count -= 1
+                if not count:
+                    return messages[position]
+        raise IndexError("%s message index out of range" % ("bot" if bot else "user"))
+
+    def get_bot_message(self, index, normalized=False):
+        return self.__get_message(index, True, normalized)
+
+    def get_user_message(self, index, normalized=False):
+        return self.__get_message(index, False, normalized)
+
+    def previous(self, bot, depth, skip=0):
+        """
+        Normalized messages of the bot or of the user, the most recent one first.
+
+        :type bot: bool
+        :param bot: messages of the bot, or of the user
+        :type depth: int
+        :param depth: messages given at most
+        :type skip: int
+        :param skip: most recent messages left out
+        :rtype: generator of str
+        """
+        for position in self.__positions(reverse=True):
+            if self._bot[position] != bot:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            if not depth:
+                return
+            depth -= 1
+            yield self._normalized[position]
+
+    def state(self):
+        """
+        :rtype: list
+        :return: json serializable ["bot" or "user", message] pairs
+        """
+        return [["bot" if bot else "user", message] for bot, message in self.items()]
+
+    @classmethod
+    def from_state(cls, state, depth=None, normalizer=None):
+        conversation = cls(depth=depth, normalizer=normalizer)
+        for role, message in state:
+            conversation.__append(message, role == "bot")
+        return conversation
+
+    @classmethod
+    def from_messages(cls, messages, depth=None, normalizer=None):
+        """
+        Conversation of a list of messages, as sessions held them before conversations kept who said what.
+
+        :type messages: list
+        :param messages: ("bot" or "user", message) pairs like `state` returns, or messages said in turn
+            by the user and the bot, the last one by the bot
+        :rtype: Conversation
+        """
+        messages = list(messages)
+        if all(isinstance(message, str) for message in messages):
+            first = "bot" if len(messages) % 2 else "user"
+            roles = [first, "user" if first == "bot" else "bot"]
+            return cls.from_state(((roles[i % 2], message) for i, message in enumerate(messages)), depth,
+                                  normalizer)
+        for pair in messages:
+            if isinstance(pair, str) or len(pair) != 2 or pair[0] not in ("bot", "user"):
+                raise ValueError("(\"bot\" or \"user\", message) pair expected found %r" % (pair,))
+        return cls.from_state(messages, depth, normalizer)
+
+    def __repr__(self):
+        return "Conversation(%r)" % self.state()
 
 
 class SessionHandler:
+    """
+    Deprecated, Chat keeps the state of a session in a SessionState and no longer uses it.
+    """
 
     def __init__(self, _class, **kwargs):
+        warn("SessionHandler is deprecated and will be removed, sessions are kept in SessionState",
+             DeprecationWarning, stacklevel=2)
         self._class = _class
         self.__data = {key: _class(value) for key, value in kwargs.items()}
 
@@ -126,3 +371,69 @@ class SessionHandler:
 
     def values(self):
         return self.__data.values()
+
+
+class SessionTracker:
+    """
+    Sessions in least recently used order, picking the ones to evict once there are
+    more than max_sessions of them or they have been idle for more than ttl seconds.
+    """
+
+    def __init__(self, max_sessions=None, ttl=None):
+        """
+        :type max_sessions: int
+        :param max_sessions: sessions kept, None for no limit
+        :type ttl: float
+        :param ttl: seconds a session is kept after its last use, None for no limit
+        """
+        if (max_sessions is not None and max_sessions < 1) or (ttl is not None and ttl <= 0):
+            raise ValueError("max_sessions and session ttl should be positive")
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_used = OrderedDict()
+
+    def touch(self, session_id=None):
+        """
+        Mark a session as used, and pick the sessions to evict.
+
+        :type session_id: str
+        :param session_id: session being used, None to only look for expired sessions
+        :rtype: list
+        :return: ids of the sessions to evict, no longer tracked
+        """
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            if session_id is not None:
+                self._last_used[session_id] = now
+                self._last_used.move_to_end(session_id)
+            for oldest, last_used in self._last_used.items():
+                if oldest == session_id:
+                    break
+                if self.max_sessions is not None and len(self._last_used) - len(evicted) > self.max_sessions:
+                    evicted.append(oldest)
+                elif self.ttl is not None and now - last_used > self.ttl:
+                    evicted.append(oldest)
+                else:
+                    break
+            for oldest in evicted:
+                del self._last_used[oldest]
+        return evicted
+
+    def keep(self, session_id):
+        """
+        Track again a session picked by touch but not evicted, as the most recently used one.
+        """
+        with self._lock:
+            self._last_used[session_id] = time.monotonic()
+
+    def discard(self, session_id):
+        with self._lock:
+            self._last_used.pop(session_id, None)
+
+    def __contains__(self, session_id):
+        return session_id in self._last_used
+
+    def __len__(self):
+        return len(self._last_used)
@@ -0,0 +1,209 @@
+from heapq import merge
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, "POSSESSIVE_REPEAT"):
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+def _flatten(items, out):
+    """
+    Flatten a parsed regex into the characters it is guaranteed to consume,
+    using None as a separator wherever the consumed text is not a known literal.
+    Characters are case folded and only ASCII literals are kept.
+    """
+    for op, av in items:
+        if op is sre_constants.LITERAL and av < 128:
+            out.append(chr(av).lower())
+        elif op is sre_constants.SUBPATTERN:
+            _flatten(av[-1], out)
+        elif op in _REPEATS and av[0] >= 1:
+            out.append(None)
+            _flatten(av[2], out)
+            out.append(None)
+        elif op is not sre_constants.AT:
+            out.append(None)
+    return out
+
+
+def required_literals(pattern):
+    """
+    Literal text every match of `pattern` must contain.
+
+    :type pattern: re.Pattern
+    :param pattern: compiled client pattern
+    :rtype: tuple
+    :return: (prefix, tokens) where prefix is the lower cased text every match
+             starts with and tokens are lower cased substrings every match contains
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return "", ()
+    runs, current = [], []
+    for char in _flatten(list(parsed), []):
+        if char is None:
+            runs.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    runs.append("".join(current))
+    return runs[0], tuple(sorted({run for run in runs[1:] if run}, key=len, reverse=True))
+
+
+class PreviousPattern:
+    """
+    Prev pattern matched against the last `depth` messages of the bot or of the
+    user ({% prev user 3 %}), the most recent one first.
+    """
+    __slots__ = ("pattern", "bot", "depth")
+
+    def __init__(self, pattern, bot=True, depth=1):
+        self.pattern = pattern
+        self.bot = bot
+        self.depth = depth
+
+    def match(self, history):
+        """
+        :type history: function
+        :param history: history(bot, depth) giving the normalized previous messages, the most recent one first
+        :rtype: re.Match
+        """
+        for message in history(self.bot, self.depth):
+            match = self.pattern.match(message)
+            if match:
+                return match
+        return None
+
+
+class IntentMatcher:
+    """
+    Index over the client patterns of one topic.
+
+    Patterns are bucketed by the first character of their literal prefix and
+    carry the literal tokens they require, so a message only runs the regexes
+    that can possibly match it. Blocks are tried in the same order as the
+    pairs list and the first match wins.
+    """
+
+    def __init__(self, blocks=()):
+        self._priority = 0
+        self._entries = []
+        self._floating = []
+        self._anchored = {}
+        self.prepend(blocks)
+
+    def prepend(self, blocks, literals=None):
+        """
+        Add blocks ahead of the ones already indexed, keeping their relative order.
+
+        :type blocks: list of tuple
+        :param blocks: compiled (patterns, parents, responses, learn) blocks
+        :type literals: list of tuple
+        :param literals: required_literals of the client patterns of every block, None to compute them
+        """
+        for position in range(len(blocks) - 1, -1, -1):
+            block = blocks[position]
+            self._priority -= 1
+            for index in range(len(block[0]) - 1, -1, -1):
+                pattern = block[0][index]
+                prefix, tokens = required_literals(pattern) if literals is None else literals[position][index]
+                entry = (self._priority, index, pattern, prefix, tokens, block)
+                self._entries.append(entry)
+                if prefix:
+                    self._anchored.setdefault(prefix[0], []).append(entry)
+                else:
+                    self._floating.append(entry)
+
+    def prepend_matcher(self, matcher):
+        """
+        Add the blocks indexed by another matcher ahead of the ones already indexed,
+        same as prepend(blocks) without analysing their patterns again.
+
+        :type matcher: IntentMatcher
+        """
+        offset = self._priority
+        for entry in matcher._entries:
+            entry = (entry[0] + offset,) + entry[1:]
+            self._entries.append(entry)
+            if entry[3]:
+                self._anchored.setdefault(entry[3][0], []).append(entry)
+            else:
+                self._floating.append(entry)
+        self._priority += matcher._priority
+
+    def copy(self):
+        """
+        Independent matcher over the same blocks, cheaper than indexing them again.
+        """
+        matcher = IntentMatcher()
+        matcher._priority = self._priority
+        matcher._entries = list(self._entries)
+        matcher._floating = list(self._floating)
+        matcher._anchored = {key: list(entries) for key, entries in self._anchored.items()}
+        return matcher
+
+    def __len__(self):
+        return len(self._entries)
+
+    def candidates(self, text):
+        """
+        Entries whose pattern may match `text`, in priority order.
+        """
+        if not text.isascii():
+            # case insensitive matching of non ASCII text can map onto ASCII
+            # literals (e.g. KELVIN SIGN matches k), so don't filter it
+            return reversed(self._entries)
+        folded = text.lower()
+        anchored = self._anchored.get(folded[:1])
+        entries = merge(reversed(anchored), reversed(self._floating)) if anchored else reversed(self._floating)
+        return (entry for entry in entries
+                if folded.startswith(entry[3]) and all(token in folded for token in entry[4]))
+
+    def match(self, text, previous_text, history=None, metrics=None):
+        """
+        Select the first block matching `text` (and `previous_text` for blocks with prev patterns).
+
+        :type text: str
+        :param text: normalized client message
+        :type previous_text: str
+        :param previous_text: normalized previous bot message
+        :type history: function
+        :param history: previous messages for PreviousPattern prev patterns, see PreviousPattern.match
+        :type metrics: metrics.MessageMetrics
+        :param metrics: counts the client patterns run, None to not count them
+        :rtype: tuple
+        :return: (match, parent_match, responses, learn) or None
+        """
+        resolved = result = None
+        tried = 0
+        for priority, _, pattern, _, _, block in self.candidates(text):
+            if priority == resolved:
+                continue
+            tried += 1
+            match = pattern.match(text)
+            if not match:
+                continue
+            resolved = priority
+            parents = block[1]
+            if parents is None:
+                result = match, None, block[2], block[3]
+                break
+            for parent in parents:
+                if isinstance(parent, PreviousPattern):
+                    parent_match = parent.match(history) if history is not None else None
+                else:
+                    parent_match = parent.match(previous_text)
+                if parent_match:
+                    result = match, parent_match, block[2], block[3]
+                    break
+            if result is not None:
+                break
+        if metrics is not None:
+            metrics.patterns_tried += tried
+        return result
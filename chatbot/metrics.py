@@ -0,0 +1,116 @@
+import logging
+import time
+
+STAGES = ("normalize", "spell_correction", "intent_selection", "condition", "call", "eval")
+# counters of a CacheInfo, the other fields are sizes
+CACHE_COUNTERS = ("hits", "misses", "evictions")
+
+logger = logging.getLogger("chatbot")
+
+
+class MessageMetrics:
+    """
+    Where the time of one reply went.
+
+    `stages` holds the seconds spent in every stage and `counts` how many times it
+    ran, a stage nested in another (e.g. a call in a condition) is also counted in
+    the enclosing one. `details` lists the (stage, name, seconds) of every call and
+    eval tag, `patterns_tried` the client patterns run against the message and
+    `topic_depth` how many parent topics were tried before one replied (None when
+    none did). `caches` holds the hits and misses of the caches of the Chat during
+    the reply, once it is finished; the caches are shared, lookups made by replies
+    running at the same time are counted too.
+    """
+    __slots__ = ("session_id", "message", "start", "duration", "stages", "counts", "details", "patterns_tried",
+                 "topic_depth", "caches", "_cache_info", "_caches_before")
+
+    def __init__(self, session_id, message, cache_info=None):
+        self.session_id = session_id
+        self.message = message
+        self.start = time.perf_counter()
+        self.duration = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.counts = dict.fromkeys(STAGES, 0)
+        self.details = []
+        self.patterns_tried = 0
+        self.topic_depth = None
+        self.caches = {}
+        self._cache_info = cache_info
+        self._caches_before = None if cache_info is None else cache_info()
+
+    def add(self, stage, seconds, name=None):
+        self.stages[stage] += seconds
+        self.counts[stage] += 1
+        if name is not None:
+            self.details.append((stage, name, seconds))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        if self._cache_info is not None:
+            self.caches = cache_difference(self._caches_before, self._cache_info())
+        return self
+
+    def __repr__(self):
+        stages = ", ".join("%s %.2fms" % (stage, seconds * 1e3) for stage, seconds in self.stages.items() if seconds)
+        return "<MessageMetrics %.2fms in session %s: %s>" % (
+            (self.duration or 0) * 1e3, self.session_id, stages or "no stage")
+
+
+def cache_difference(before, after):
+    """
+    :type before: dict
+    :param before: {name: CacheInfo} when the reply started
+    :type after: dict
+    :param after: {name: CacheInfo} once it finished
+    :rtype: dict
+    :return: {name: CacheInfo} with the hits, misses and evictions in between and the sizes once finished
+    """
+    caches = {}
+    for name, info in after.items():
+        previous = before.get(name)
+        if info is not None and previous is not None:
+            info = info._replace(**{field: getattr(info, field) - getattr(previous, field)
+                                    for field in CACHE_COUNTERS if field in info._fields})
+        caches[name] = info
+    return caches
+
+
+def timed(metrics, stage, function, *args):
+    """
+    function(*args), adding its duration to the stage of metrics unless metrics is None.
+    """
+    if metrics is None:
+        return function(*args)
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        metrics.add(stage, time.perf_counter() - start)
+
+
+class SlowMessageLog:
+    """
+    Log the replies taking at least `threshold` seconds, with the time of each stage.
+    """
+
+    def __init__(self, threshold, log=logger):
+        """
+        :type threshold: float
+        :param threshold: seconds
+        :type log: logging.Logger
+        :param log: where slow replies are logged, as warnings
+        """
+        if threshold < 0:
+            raise ValueError("slow message threshold should be positive found %s" % threshold)
+        self.threshold = threshold
+        self.log = log
+
+    def __call__(self, metrics):
+        if metrics.duration < self.threshold:
+            return
+        stages = ", ".join("%s %.1fms" % (stage, seconds * 1e3)
+                           for stage, seconds in metrics.stages.items() if seconds)
+        details = ", ".join("%s %s %.1fms" % (stage, name, seconds * 1e3) for stage, name, seconds in metrics.details)
+        self.log.warning("slow reply (%.1fms) in session %s to %r: %s%s, %d patterns tried, topic depth %s",
+                         metrics.duration * 1e3, metrics.session_id, metrics.message, stages or "no stage",
+                         " (%s)" % details if details else "", metrics.patterns_tried, metrics.topic_depth)
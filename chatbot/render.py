@@ -0,0 +1,135 @@
+import re
+
+RE_NAMED_GROUP = re.compile(r'%([a-zA-Z_][a-zA-Z_0-9]*)([^a-zA-Z_0-9]|$)')
+RE_NAMED_GROUP_SILENT = re.compile(r'%!([a-zA-Z_][a-zA-Z_0-9]*)([^a-zA-Z_0-9]|$)')
+RE_NUMBERED_GROUP = re.compile(r'%[0-9]+')
+RE_NUMBERED_GROUP_SILENT = re.compile(r'%![0-9]+')
+RE_ESCAPED = re.compile(r'\\([\[\]{}%:])')
+
+# render plan operations
+TEXT = 0  # (TEXT, pieces) literal text, str pieces are copied and int pieces are client match groups
+ACTION = 1  # (ACTION, action, plan, think, source) tag rendered by the action handler
+IF = 2  # (IF, conditions, bodies, else_body) if/elif/else chain
+
+
+def _start_pos(start, response, exp):
+    return start + re.search(r"([\s\t]*" + exp + r"[\s\t]+)", response[start:]).end(1)
+
+
+def _tag_padding(action):
+    return 1 if action in ("map", "eval") else 2
+
+
+def compile_text(text):
+    """
+    Split literal response text on its numbered group references (e.g. %1).
+
+    :type text: str
+    :rtype: tuple
+    :return: render plan of the text
+    """
+    if not text:
+        return ()
+    pieces = []
+    prev = 0
+    for m in RE_NUMBERED_GROUP.finditer(text):
+        if m.start(0) > prev:
+            pieces.append(text[prev:m.start(0)])
+        pieces.append(int(text[m.start(0) + 1:m.end(0)]))
+        prev = m.end(0)
+    if prev < len(text):
+        pieces.append(text[prev:])
+    return (TEXT, tuple(pieces)),
+
+
+def _compile_action(response, node):
+    action = node["action"]
+    start = node["start"]
+    think = False
+    if action in ("map", "eval"):
+        if response[start] == "!":
+            think = True
+            start += 1
+    else:
+        start = _start_pos(start, response, action)
+    return ACTION, action, compile_plan(response, node["child"], start, node["end"]), think, response[start:node["end"]]
+
+
+def _compile_if(response, condition, i):
+    conditions = [compile_plan(response, condition[i]["child"], _start_pos(condition[i]["start"], response, "if"),
+                               condition[i]["end"])]
+    branches = [i]
+    else_index = None
+    i += 1
+    while condition[i]["action"] != "endif":
+        if else_index is None:
+            if condition[i]["action"] == "elif":
+                conditions.append(compile_plan(response, condition[i]["child"],
+                                               _start_pos(condition[i]["start"], response, "elif"),
+                                               condition[i]["end"]))
+                branches.append(i)
+            elif condition[i]["action"] == "else":
+                else_index = i
+        i += 1
+
+    def body(index):
+        return compile_plan(response, condition[index]["within"], condition[index]["end"] + 2,
+                            condition[index + 1]["start"] - 2)
+
+    return (IF, tuple(conditions), tuple(body(index) for index in branches),
+            None if else_index is None else body(else_index)), i
+
+
+def compile_plan(response, condition=(), start=0, end=None):
+    """
+    Compile a response and its condition tree (see Chat._condition) into a flat render plan.
+
+    :type response: str
+    :param response: response template
+    :type condition: list
+    :param condition: condition tree of the response
+    :type start: int
+    :param start: start of the rendered part of the response
+    :type end: int
+    :param end: end of the rendered part of the response, None for the end of the response
+    :rtype: tuple
+    :return: operations rendered one after the other
+    """
+    end = len(response) if end is None else end
+    if not condition:
+        return compile_text(response[start:end])
+    plan = []
+    i = 0
+    while i < len(condition):
+        action = condition[i]["action"]
+        plan.extend(compile_text(response[start:condition[i]["start"] - _tag_padding(action)]))
+        if action == "if":
+            op, i = _compile_if(response, condition, i)
+        else:
+            op = _compile_action(response, condition[i])
+        plan.append(op)
+        start = condition[i]["end"] + _tag_padding(condition[i]["action"])
+        i += 1
+    plan.extend(compile_text(response[start:end]))
+    return tuple(plan)
+
+
+class RenderContext:
+    """
+    State of one response being rendered: the client matches and the quote and
+    reflection substitution toggles, replaced rather than changed by nested tags.
+    """
+    __slots__ = ("match", "parent_match", "quote", "substitute")
+
+    def __init__(self, match=None, parent_match=None, quote=False, substitute=True):
+        self.match = match
+        self.parent_match = parent_match
+        self.quote = quote
+        self.substitute = substitute
+
+    def replace(self, quote=None, substitute=None):
+        quote = self.quote if quote is None else quote
+        substitute = self.substitute if substitute is None else substitute
+        if quote == self.quote and substitute == self.substitute:
+            return self
+        return RenderContext(self.match, self.parent_match, quote, substitute)
@@ -0,0 +1,57 @@
+import threading
+from os import path
+from .spellcheck import SpellChecker, DEFAULT_CACHE_SIZE
+from .substitution import Substitution
+
+
+class ResourceRegistry:
+    """
+    Process wide cache of language resources shared by Chat instances.
+
+    Resources are keyed by `(local_path, language)` and built once, on first
+    use. Everything handed out is shared between every Chat using the
+    registry and must be treated as read only.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._resources = {}
+
+    def get(self, key, factory):
+        """
+        Resource stored under key, built with factory() the first time it is requested.
+        """
+        try:
+            return self._resources[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = factory()
+            return self._resources[key]
+
+    def spell_checker(self, local_path, language, engine="norvig", cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param engine: see SpellChecker, spell checkers of different engines or cache sizes aren't shared
+        :rtype: SpellChecker
+        """
+        local_path = path.abspath(local_path)
+        return self.get(("spell_checker", local_path, language, engine, cache_size),
+                        lambda: SpellChecker(local_path, language, engine, cache_size))
+
+    def substitution(self, local_path, language):
+        """
+        :rtype: Substitution
+        """
+        local_path = path.abspath(local_path)
+        return self.get(("substitution", local_path, language), lambda: Substitution(local_path, language))
+
+    def clear(self):
+        """
+        Forget every resource, Chat instances created afterwards load them again.
+        """
+        with self._lock:
+            self._resources.clear()
+
+    def __len__(self):
+        return len(self._resources)
@@ -0,0 +1,113 @@
+import asyncio
+import inspect
+import threading
+
+_RETRY = object()
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+class SingleFlight:
+    """
+    Share one execution between the concurrent calls made with the same key.
+
+    The first caller of a key runs the function, the callers arriving while it
+    runs wait for it and get its result (or its exception). Nothing is kept
+    once the execution returns, caching results is left to the caller.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.shared = 0
+
+    def __getstate__(self):
+        # executions in flight stay with the process running them
+        return {"shared": self.shared}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.shared = state["shared"]
+
+    def do(self, key, function, *args):
+        """
+        Run function(*args) in this thread, or wait for the thread already running it for key.
+
+        :type key: hashable
+        :param key: identity of the call, equal keys share one execution
+        :return: result of the function
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key, function, *args):
+        """
+        Coroutine version of `do`, awaiting the result of the function when it is awaitable.
+
+        Executions are shared between the tasks of one event loop. When the task
+        running the function is cancelled, the tasks waiting for it start over,
+        one of them running the function again.
+        """
+        loop = asyncio.get_running_loop()
+        key = (loop, key)
+        while True:
+            with self._lock:
+                future = self._flights.get(key)
+                leader = future is None
+                if leader:
+                    future = self._flights[key] = loop.create_future()
+                else:
+                    self.shared += 1
+            if leader:
+                return await self.__lead(key, future, function, args)
+            result = await asyncio.shield(future)
+            if result is not _RETRY:
+                return result
+            with self._lock:
+                self.shared -= 1
+
+    async def __lead(self, key, future, function, args):
+        try:
+            result = function(*args)
+            if inspect.isawaitable(result):
+                result = await result
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # only this task is cancelled, not the call the others are waiting for
+            future.set_result(_RETRY)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # the waiters, if any, get the exception, don't warn about it being never retrieved
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
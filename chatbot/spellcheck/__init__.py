@@ -1,22 +1,88 @@
 import re
 from os import path
 from collections import Counter
+from functools import lru_cache
 from warnings import warn
+from .symspell import SymmetricDeleteIndex
+from .store import WordStore
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+ENGINES = ("norvig", "symspell")
+DEFAULT_CACHE_SIZE = 4096
+
+
+def compile_words(local_path, language='en'):
+    """
+    Compile `<language>/words.txt` into the memory mapped `<language>/words.dat` used by SpellChecker.
+    :param local_path: directory holding `<language>/words.txt`
+    :param language: str
+    :return: path of the compiled file
+    """
+    with open(path.join(local_path, language, "words.txt"), encoding='utf-8') as words:
+        counts = Counter(SpellChecker.words(words.read()))
+    file_name = path.join(local_path, language, "words.dat")
+    WordStore.write(file_name, counts)
+    return file_name
 
 
 class SpellChecker:
 
-    def __init__(self, local_path, language='en'):
+    def __init__(self, local_path, language='en', engine="norvig", cache_size=DEFAULT_CACHE_SIZE,
+                 precompiled=True):
+        """
+        :param local_path: directory holding `<language>/words.txt`
+        :param language: str
+        :param engine: candidate engine, "norvig" generates every edit of a word and
+            "symspell" looks words up in a precomputed symmetric delete index. The index is
+            built on the first correction after the words change and is large: about 340MB
+            and 5s per 100k words
+        :param cache_size: number of corrected words remembered, None for unbounded and 0 to disable
+        :param precompiled: use `<language>/words.dat` (see compile_words) when it is up to date with words.txt
+        """
+        if engine not in ENGINES:
+            raise ValueError("engine should be one of %s found '%s'" % (", ".join(ENGINES), engine))
+        self.engine = engine
+        self._most_probable = lru_cache(maxsize=cache_size)(self.most_probable)
+        words_file = path.join(local_path, language, "words.txt")
+        store_file = path.join(local_path, language, "words.dat")
+        if precompiled and path.isfile(store_file) and (
+                not path.isfile(words_file) or path.getmtime(store_file) >= path.getmtime(words_file)):
+            self.WORDS = WordStore(store_file)
+            return
         try:
-            self.WORDS = Counter(self.words(open(path.join(
-                local_path, language, "words.txt"), encoding='utf-8').read()))
+            self.WORDS = Counter(self.words(open(words_file, encoding='utf-8').read()))
         except FileNotFoundError:
             warn("words.txt for language `{}` not found in `{}`".format(language, local_path),
                  ResourceWarning)
             self.WORDS = Counter()
-        self.total_word_count = sum(self.WORDS.values())
+
+    @property
+    def WORDS(self):
+        return self._words
+
+    @WORDS.setter
+    def WORDS(self, words):
+        self._words = words
+        self.words_changed()
+
+    def words_changed(self):
+        """
+        Refresh everything derived from the word table.
+        Assigning WORDS does this already, call it after changing WORDS in place.
+        """
+        self.total_word_count = sum(self._words.values())
         if self.total_word_count == 0:
             self.total_word_count = 1
+        # the symspell index is built on the next correction
+        self._index = None
+        self._most_probable.cache_clear()
+
+    def cache_info(self):
+        """
+        Hits, misses and size of the correction cache.
+        :return: functools CacheInfo
+        """
+        return self._most_probable.cache_info()
 
     @staticmethod
     def words(text):
@@ -30,9 +96,17 @@ class SpellChecker:
         :return: str
         """
         return " ".join(i if len(i) < min_word_length or self.WORDS[i]
-                        else max(self.candidates(i), key=self.probability)
+                        else self._most_probable(i)
                         for i in text.split())
 
+    def most_probable(self, word):
+        """
+        Most probable spelling correction for word.
+        :param word: str
+        :return: str
+        """
+        return max(self.candidates(word), key=self.probability)
+
     def probability(self, word):
         """
         Probability of `word`.
@@ -47,9 +121,29 @@ class SpellChecker:
         :param word: str
         :return: set of known words
         """
+        if self.engine == "symspell":
+            return self.indexed_candidates(word)
         return (self.known([word]) or self.known(self.edits1(word)) or
                 self.known(self.edits2(word)) or [word])
 
+    def indexed_candidates(self, word):
+        """
+        Same candidates as the edit based lookup, taken from the symmetric delete index.
+        :param word: str
+        :return: set of known words
+        """
+        if word in self.WORDS:
+            return {word}
+        index = self._index
+        if index is None:
+            # concurrent first corrections may both build it, they build the same index
+            index = self._index = SymmetricDeleteIndex(self._words)
+        nearby = index.lookup(word)
+        edits = self.edits1(word)
+        alphabet = set(LETTERS).union(word)
+        return ({w for w in nearby if w in edits} or
+                {w for w in nearby if not edits.isdisjoint(self.reverse_edits1(w, alphabet))} or [word])
+
     def known(self, words):
         """
         The subset of `words` that appear in the dictionary of WORDS.
@@ -65,14 +159,28 @@ class SpellChecker:
         :param word: String
         :return: set of words
         """
-        letters = 'abcdefghijklmnopqrstuvwxyz'
         splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
         deletes = [L + R[1:] for L, R in splits if R]
         transposes = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R) > 1]
-        replaces = [L + c + R[1:] for L, R in splits if R for c in letters]
-        inserts = [L + c + R for L, R in splits for c in letters]
+        replaces = [L + c + R[1:] for L, R in splits if R for c in LETTERS]
+        inserts = [L + c + R for L, R in splits for c in LETTERS]
         return set(deletes + transposes + replaces + inserts)
 
+    @staticmethod
+    def reverse_edits1(word, alphabet):
+        """
+        All strings over `alphabet` (and the characters of `word`) that have `word` among their edits1.
+        :param word: String
+        :param alphabet: set of characters
+        :return: set of words
+        """
+        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        inserts = [L + c + R for L, R in splits for c in alphabet]
+        deletes = [L + R[1:] for L, R in splits if R and R[0] in LETTERS]
+        transposes = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R) > 1]
+        replaces = [L + c + R[1:] for L, R in splits if R and R[0] in LETTERS for c in alphabet]
+        return set(inserts + deletes + transposes + replaces)
+
     def edits2(self, word):
         """
         All edits that are two edits away from `word`.
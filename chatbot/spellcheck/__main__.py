@@ -0,0 +1,20 @@
+from argparse import ArgumentParser
+from os import path, listdir
+from . import compile_words
+
+
+def main(args=None):
+    parser = ArgumentParser(prog="python -m chatbot.spellcheck",
+                            description="Compile words.txt into the memory mapped words.dat used for spell checking")
+    parser.add_argument("languages", nargs="*", help="languages to compile (default: all with a words.txt)")
+    parser.add_argument("--local-path", default=path.join(path.dirname(path.dirname(path.abspath(__file__))), "local"),
+                        help="directory holding <language>/words.txt")
+    args = parser.parse_args(args)
+    languages = args.languages or sorted(language for language in listdir(args.local_path)
+                                         if path.isfile(path.join(args.local_path, language, "words.txt")))
+    for language in languages:
+        print(compile_words(args.local_path, language))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import mmap
+import os
+import sys
+from array import array
+from heapq import nlargest
+from struct import Struct
+from zlib import crc32
+
+MAGIC = b"CBWORDS1"
+HEADER = Struct("<8sIIQ")
+
+
+def _array(data):
+    values = array("I")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class WordStore:
+    """
+    Read only word frequency table stored in a memory mapped file.
+
+    The file holds the words sorted by their UTF-8 encoding together with an
+    array of their frequencies, so it can be opened without parsing and its
+    pages are shared by every process that maps it. An open addressing table
+    of crc32 hashes finds a word in one or two probes. Lookups behave like a
+    `collections.Counter`: unknown words have a frequency of 0.
+
+    Layout (little endian): header (magic, word count, hash table size, total),
+    file offsets of the words as uint32 (count + 1), frequencies as uint32
+    (count), hash table of word index + 1 as uint32 and the concatenated words.
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, table_size, self.total = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a word store" % file_name)
+        sections = []
+        start = HEADER.size
+        for length in (count + 1, count, table_size):
+            sections.append((start, start + length * 4))
+            start += length * 4
+        view = memoryview(self._map)
+        if sys.byteorder == "little":
+            self._offsets, self._counts, self._table = (view[begin:end].cast("I") for begin, end in sections)
+        else:
+            self._offsets, self._counts, self._table = (_array(view[begin:end]) for begin, end in sections)
+        self._mask = table_size - 1
+
+    @staticmethod
+    def write(file_name, counts):
+        """
+        Write a word frequency mapping as a word store.
+        :param file_name: target file
+        :param counts: mapping of word to frequency (e.g. Counter)
+        """
+        words = sorted((word.encode("utf-8"), count) for word, count in counts.items() if count > 0)
+        table_size = 1
+        while table_size < len(words) * 2:
+            table_size *= 2
+        mask = table_size - 1
+        table = array("I", bytes(table_size * 4))
+        offsets = array("I", [HEADER.size + (len(words) * 2 + 1 + table_size) * 4])
+        frequencies = array("I")
+        for index, (word, count) in enumerate(words):
+            offsets.append(offsets[-1] + len(word))
+            frequencies.append(count)
+            slot = crc32(word) & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = index + 1
+        total = sum(frequencies)
+        if sys.byteorder == "big":
+            for values in (offsets, frequencies, table):
+                values.byteswap()
+        temporary = "%s.%d.tmp" % (file_name, os.getpid())
+        with open(temporary, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(words), table_size, total))
+            for values in (offsets, frequencies, table):
+                file.write(values.tobytes())
+            file.write(b"".join(word for word, _ in words))
+        os.replace(temporary, file_name)
+
+    def index(self, word):
+        """
+        Position of `word` in the store or -1.
+        """
+        key = word.encode("utf-8")
+        data, offsets, table, mask = self._map, self._offsets, self._table, self._mask
+        slot = crc32(key) & mask
+        index = table[slot]
+        while index:
+            if data[offsets[index - 1]:offsets[index]] == key:
+                return index - 1
+            slot = (slot + 1) & mask
+            index = table[slot]
+        return -1
+
+    def word(self, index):
+        return self._map[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def __getitem__(self, word):
+        index = self.index(word)
+        return self._counts[index] if index >= 0 else 0
+
+    def get(self, word, default=None):
+        index = self.index(word)
+        return self._counts[index] if index >= 0 else default
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return (self.word(index) for index in range(len(self._counts)))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return self._counts
+
+    def items(self):
+        return ((self.word(index), self._counts[index]) for index in range(len(self._counts)))
+
+    def most_common(self, n=None):
+        """
+        List the n most common words and their counts from the most common to the least.
+        """
+        counts = self._counts
+        indexes = range(len(counts))
+        if n is None:
+            indexes = sorted(indexes, key=counts.__getitem__, reverse=True)
+        else:
+            indexes = nlargest(n, indexes, key=counts.__getitem__)
+        return [(self.word(index), counts[index]) for index in indexes]
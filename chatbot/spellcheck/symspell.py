@@ -0,0 +1,50 @@
+class SymmetricDeleteIndex:
+    """
+    Symmetric delete index (as used by SymSpell) over a dictionary of words.
+
+    Every word is stored under each string obtained by deleting up to
+    `max_distance` characters from its first `prefix_length` characters. Any
+    word within `max_distance` edits of a query shares at least one of those
+    delete variants with it, so a lookup only needs the deletes of the query
+    instead of generating every possible edit.
+    """
+
+    def __init__(self, words=(), max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self._deletes = {}
+        for word in words:
+            self.add(word)
+
+    def deletes(self, word):
+        """
+        All strings obtained by deleting up to `max_distance` characters from the prefix of `word`.
+        :param word: str
+        :return: set of str
+        """
+        edge = {word[:self.prefix_length]}
+        variants = set(edge)
+        for _ in range(self.max_distance):
+            edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+            variants.update(edge)
+        return variants
+
+    def add(self, word):
+        for delete in self.deletes(word):
+            self._deletes.setdefault(delete, []).append(word)
+
+    def lookup(self, word):
+        """
+        Dictionary words that may be within `max_distance` edits of `word`.
+        The result is a superset, callers verify the actual distance.
+        :param word: str
+        :return: set of str
+        """
+        found = set()
+        for delete in self.deletes(word):
+            found.update(self._deletes.get(delete, ()))
+        length = len(word)
+        return {w for w in found if abs(len(w) - length) <= self.max_distance}
+
+    def __len__(self):
+        return len(self._deletes)
@@ -1,6 +1,7 @@
 from warnings import warn
 from os import path
 import json
+from .trie import TokenTrie  # noqa: F401
 
 
 class Substitution:
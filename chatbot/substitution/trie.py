@@ -0,0 +1,95 @@
+import re
+
+RE_TOKEN = re.compile(r"\w+|\W")
+_END = None
+
+
+def tokenize(text):
+    """
+    Split text into runs of word characters and single other characters.
+    :param text: str
+    :return: list of str
+    """
+    return RE_TOKEN.findall(text)
+
+
+class TokenTrie:
+    """
+    Case insensitive word and phrase substitutions, made in a single pass over the tokens of a text.
+
+    Replaces the same matches as `\\b(key1|key2|...)\\b` with re.IGNORECASE and the keys
+    sorted longest first: at every position the longest key bounded by word boundaries
+    wins and the scan goes on after it. Keys are split like the text, into runs of word
+    characters and single other characters, so a key can only match whole tokens and a
+    lookup costs one dict access per token instead of one attempt per key.
+    """
+
+    def __init__(self, substitutions=None):
+        """
+        :type substitutions: dict
+        :param substitutions: replacement of every key, keys equal but for the case share the last replacement
+        """
+        self._root = {}
+        self._first = set()
+        for key, value in (substitutions or {}).items():
+            self.add(key, value)
+
+    def add(self, key, value):
+        tokens = tokenize(key.lower())
+        if not tokens:
+            return
+        node = self._root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node[_END] = value
+        self._first.add(tokens[0])
+
+    def sub(self, text):
+        """
+        :type text: str
+        :rtype: str
+        :return: text with every match replaced
+        """
+        tokens = tokenize(text)
+        folded = tokenize(text.lower())
+        if len(folded) != len(tokens):
+            # lower() changed the length of some token, fold them one by one
+            folded = [token.lower() for token in tokens]
+        first = self._first
+        if first.isdisjoint(folded):
+            return text
+        root = self._root
+        count = len(tokens)
+        pieces = []
+        start = i = 0
+        while i < count:
+            token = folded[i]
+            # a key starts after a word boundary
+            if token not in first or not (_is_word(token) or i and _is_word(tokens[i - 1])):
+                i += 1
+                continue
+            node = root
+            end = value = None
+            j = i
+            while j < count:
+                node = node.get(folded[j])
+                if node is None:
+                    break
+                j += 1
+                # and ends before one, the longest key wins
+                if _END in node and _is_word(tokens[j - 1]) != (j < count and _is_word(tokens[j])):
+                    end, value = j, node[_END]
+            if end is None:
+                i += 1
+                continue
+            pieces.extend(tokens[start:i])
+            pieces.append(value)
+            start = i = end
+        if not pieces:
+            return text
+        pieces.extend(tokens[start:])
+        return "".join(pieces)
+
+
+def _is_word(token):
+    return token[0].isalnum() or token[0] == "_"
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pickle
+import stat
+import sys
+from . import version
+
+CACHE_FORMAT = 3
+CACHE_SUFFIX = ".cache"
+
+
+def user_cache_directory():
+    """
+    Cache directory of the library for the current user: `%LOCALAPPDATA%\\chatbot` on Windows,
+    `$XDG_CACHE_HOME/chatbot` or `~/.cache/chatbot` elsewhere.
+
+    :rtype: str
+    """
+    if os.name == "nt" and os.environ.get("LOCALAPPDATA"):
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "chatbot")
+
+
+class TemplateCache:
+    """
+    Compiled templates pickled in a directory, or next to their template file.
+
+    An entry is only used when its key matches, the key covers the template
+    content, the library version, the cache format, the Python version and
+    whatever else changes the compiled result (e.g. the normalizer). Failing to
+    read or write a cache file is never an error, the template is compiled
+    from source instead. Loading a cached template compiles its regexes again
+    (pickled patterns are compiled when unpickled), only parsing the template is
+    saved.
+
+    Cache files are pickles, loading one runs whatever code it holds, so they
+    must be as trusted as the code of the bot. Where file ownership exists (not
+    on Windows) they are only read and written when both the file and its
+    directory belong to the current user (or root) and aren't writable by the
+    group or others.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :type directory: str
+        :param directory: Where cache files are written, created private if missing, None to write them
+            next to the template. Use a directory of the application, not a shared one like /tmp
+        """
+        self.directory = directory
+
+    @staticmethod
+    def trusted(status):
+        """
+        Whether a file or directory can only be changed by the current user (or root).
+
+        :type status: os.stat_result
+        """
+        if not hasattr(os, "getuid"):
+            return True
+        return status.st_uid in (os.getuid(), 0) and not status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def __trusted_directory(self, file_name):
+        try:
+            return self.trusted(os.stat(os.path.dirname(os.path.abspath(file_name))))
+        except OSError:
+            return False
+
+    def file_name(self, template):
+        if self.directory is None:
+            return template + CACHE_SUFFIX
+        digest = hashlib.sha256(os.path.abspath(template).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, "%s.%s%s" % (os.path.basename(template), digest, CACHE_SUFFIX))
+
+    @staticmethod
+    def key(text, *extra):
+        """
+        Cache key of a template.
+
+        :type text: bytes
+        :param text: content of the template file
+        :param extra: picklable values the compiled template depends on
+        :rtype: tuple
+        """
+        return (hashlib.sha256(text).hexdigest(), version.__version__, CACHE_FORMAT,
+                tuple(sys.version_info[:2])) + extra
+
+    def load(self, template, key):
+        """
+        Compiled template stored for `key` or None.
+        """
+        file_name = self.file_name(template)
+        if not self.__trusted_directory(file_name):
+            return None
+        try:
+            with open(file_name, "rb") as file:
+                if not self.trusted(os.fstat(file.fileno())):
+                    return None
+                stored_key, value = pickle.load(file)
+        except Exception:
+            return None
+        return value if stored_key == key else None
+
+    def dump(self, template, key, value):
+        file_name = self.file_name(template)
+        temporary = "%s.%d.tmp" % (file_name, os.getpid())
+        try:
+            if self.directory is not None:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if not self.__trusted_directory(file_name):
+                return
+            with open(temporary, "wb") as file:
+                pickle.dump((key, value), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, file_name)
+        except Exception:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
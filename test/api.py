@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+from chatbot.api import ApiClient
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        with server.lock:
+            server.hits[url.path] = server.hits.get(url.path, 0) + 1
+            server.clients.add(self.client_address)
+            hits = server.hits[url.path]
+        if url.path == "/slow":
+            time.sleep(0.5)
+        headers = {}
+        if url.path == "/login":
+            with server.lock:
+                server.token = "t%d" % hits
+            headers["Set-Cookie"] = "token=%s; Path=/" % server.token
+        if url.path == "/flaky" and hits % 3:
+            status, body = 503, {}
+        elif url.path == "/private" and "token=%s" % server.token not in self.headers.get("Cookie", ""):
+            status, body = 401, {}
+        else:
+            status, body = 200, {"path": url.path, "params": dict(parse_qsl(url.query)), "hits": hits}
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    # clients giving up on /slow break the pipe
+    server.handle_error = lambda request, client_address: None
+    server.lock = threading.Lock()
+    server.hits = {}
+    server.clients = set()
+    server.token = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def api_definition(server, path, **settings):
+    definition = {"url": "http://127.0.0.1:%d%s" % (server.server_port, path), "method": "GET",
+                  "params": {"unit": "c"}, "type": "json"}
+    definition.update(settings)
+    return definition
+
+
+def connection_tests():
+    server = start_server()
+    client = ApiClient({
+        "weather": {"now": api_definition(server, "/now", value_getter=["params"])},
+        "slow": {"connection": {"timeout": 0.1}, "get": api_definition(server, "/slow")},
+        "flaky": {"connection": {"retries": 3, "retry_on_status": [503]}, "get": api_definition(server, "/flaky")},
+    })
+    for i in range(20):
+        assert client.request("weather", "now", {"city": str(i)}) == {"unit": "c", "city": str(i)}
+    assert client.request("weather", "now") == {"unit": "c"}
+    assert len(server.clients) == 1
+    try:
+        client.request("slow", "get")
+        assert False, "timeout not applied"
+    except RuntimeError:
+        pass
+    assert client.request("flaky", "get")["hits"] == 3
+    for name, method in (("weather", "connection"), ("weather", "later"), ("unknown", "now")):
+        try:
+            client.request(name, method)
+            assert False, "invalid method accepted"
+        except RuntimeError:
+            pass
+    client.close()
+    server.shutdown()
+    return 'connection_tests pass'
+
+
+def auth_tests():
+    server = start_server()
+    login = {"url": "http://127.0.0.1:%d/login" % server.server_port, "method": "GET"}
+    client = ApiClient({
+        "private": {"auth": login, "get": api_definition(server, "/private")},
+        "short": {"auth": dict(login, ttl=0.2), "get": api_definition(server, "/private")},
+    })
+    for _ in range(10):
+        assert client.request("private", "get")["path"] == "/private"
+    assert server.hits["/login"] == 1
+    server.token = "revoked"
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        assert all(result["path"] == "/private" for result in
+                   executor.map(lambda _: client.request("private", "get"), range(30)))
+    assert server.hits["/login"] == 2
+    client.request("short", "get")
+    client.request("short", "get")
+    time.sleep(0.3)
+    client.request("short", "get")
+    assert server.hits["/login"] == 4
+    server.shutdown()
+    return 'auth_tests pass'
+
+
+def cache_tests():
+    server = start_server()
+    client = ApiClient({
+        "weather": {
+            "now": api_definition(server, "/now", value_getter=["params"], cache={"ttl": 0.2, "max_entries": 2}),
+            "live": api_definition(server, "/live"),
+        },
+        "broken": {"get": api_definition(server, "/flaky", cache={"size": 2})},
+    })
+    for _ in range(5):
+        assert client.request("weather", "now", {"city": "paris"}) == {"unit": "c", "city": "paris"}
+    assert server.hits["/now"] == 1
+    assert client.cache_info("weather", "now") == (4, 1, 0, 2, 1)
+    client.request("weather", "now", {"city": "rome"})
+    client.request("weather", "now", {"city": "oslo"})
+    client.request("weather", "now", {"city": "paris"})
+    assert server.hits["/now"] == 4
+    assert client.cache_info("weather", "now").evictions == 2
+    time.sleep(0.3)
+    client.request("weather", "now", {"city": "paris"})
+    assert server.hits["/now"] == 5
+    client.request("weather", "live")
+    client.request("weather", "live")
+    assert server.hits["/live"] == 2 and client.cache_info("weather", "live") is None
+    try:
+        client.request("broken", "get")
+        assert False, "invalid cache settings accepted"
+    except ValueError:
+        pass
+    server.shutdown()
+    return 'cache_tests pass'
+
+
+def coalesce_tests():
+    server = start_server()
+    client = ApiClient({
+        "search": {
+            "get": api_definition(server, "/slow", value_getter=["params"]),
+            "fresh": api_definition(server, "/slow", coalesce=False),
+        },
+    })
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(lambda i: client.request("search", "get", {"q": str(i % 2)}), range(20)))
+    assert results == [{"unit": "c", "q": str(i % 2)} for i in range(20)]
+    assert server.hits["/slow"] == 2
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        list(executor.map(lambda i: client.request("search", "fresh"), range(5)))
+    assert server.hits["/slow"] == 7
+    server.shutdown()
+    return 'coalesce_tests pass'
+
+
+if __name__ == '__main__':
+    print(connection_tests())
+    print(auth_tests())
+    print(cache_tests())
+    print(coalesce_tests())
@@ -0,0 +1,732 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import re
+import tempfile
+import warnings
+from os import path
+from chatbot import Chat, MultiFunctionCall, mapper
+from chatbot.backend import SessionBackend, SQLiteBackend
+from chatbot.render import TEXT, ACTION, IF, compile_plan
+from chatbot.resources import ResourceRegistry
+from chatbot.singleflight import SingleFlight
+from chatbot.spellcheck import SpellChecker
+from chatbot.template_cache import TemplateCache, user_cache_directory
+
+warnings.filterwarnings("ignore", category=ResourceWarning)
+
+TEMPLATE = """
+{% block %}
+    {% client %}teach (\\w+) means (.*){% endclient %}
+    {% response %}learned %1{% endresponse %}
+    {% learn %}
+        {% block %}
+            {% client %}what is %1{% endclient %}
+            {% response %}%1 is %2{% endresponse %}
+        {% endblock %}
+    {% endlearn %}
+{% endblock %}
+{% block %}
+    {% client %}What is your name{% endclient %}
+    {% response %}I am a test bot{% endresponse %}
+{% endblock %}
+"""
+
+
+def template_file(text=TEMPLATE):
+    file_name = path.join(tempfile.mkdtemp(), "test.template")
+    with open(file_name, "w", encoding="utf-8") as template:
+        template.write(text)
+    return file_name
+
+
+def resources_tests():
+    resources = ResourceRegistry()
+    first = Chat(template_file(), resources=resources)
+    second = Chat(template_file(), resources=resources)
+    assert first.spell_checker is second.spell_checker
+    assert first.substitution is second.substitution
+    assert first._pairs['']['pairs'] is not second._pairs['']['pairs']
+    assert first._pairs['']['pairs'][-1] is second._pairs['']['pairs'][-1]
+    assert len(resources) == 3
+    assert first.say("What is your name") == "I am a test bot"
+    assert first.say("teach foo means bar") == "learned foo"
+    assert first.say("what is foo") == "foo is bar"
+    assert second.say("what is foo") != "foo is bar"
+    assert Chat(template_file(), resources=resources).say("what is foo") != "foo is bar"
+    assert Chat(template_file(), resources=None).spell_checker is not first.spell_checker
+    symspell = Chat(template_file(), resources=resources, spell_engine="symspell", spell_cache_size=10)
+    assert symspell.spell_checker is not first.spell_checker and symspell.spell_checker.engine == "symspell"
+    assert symspell.spell_checker.cache_info().maxsize == 10
+    assert Chat(template_file(), resources=None, spell_engine="symspell").spell_checker.engine == "symspell"
+    return 'resources_tests pass'
+
+
+def template_cache_tests():
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = directory = tempfile.mkdtemp()
+    try:
+        assert os.name == "nt" or user_cache_directory() == path.join(directory, "chatbot")
+    finally:
+        if cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+    # not in the package directory, it may be read only or shared
+    file_name = template_file()
+    cache = TemplateCache(user_cache_directory())
+    Chat(file_name, template_cache=cache)
+    assert path.exists(cache.file_name(file_name)) and not path.exists(file_name + ".cache")
+    cache = TemplateCache()
+    assert not path.exists(cache.file_name(file_name))
+    first = Chat(file_name, template_cache=cache)
+    assert path.exists(cache.file_name(file_name))
+    second = Chat(file_name, template_cache=cache)
+    assert second.say("What is your name") == first.say("What is your name") == "I am a test bot"
+    assert second.say("teach foo means bar") == "learned foo"
+    assert second.say("what is foo") == "foo is bar"
+    with open(file_name, "a", encoding="utf-8") as template:
+        template.write(TEMPLATE.replace("What is your name", "Who are you"))
+    assert Chat(file_name, template_cache=cache).say("Who are you") == "I am a test bot"
+    with open(cache.file_name(file_name), "wb") as file:
+        file.write(b"corrupted")
+    assert Chat(file_name, template_cache=cache).say("Who are you") == "I am a test bot"
+    directory = tempfile.mkdtemp()
+    Chat(file_name, template_cache=TemplateCache(directory))
+    assert len(os.listdir(directory)) == 1
+    if hasattr(os, "getuid"):
+        # caches that others can change are neither read nor written
+        cache = TemplateCache(directory)
+        key = cache.key(b"text")
+        cache.dump(file_name, key, "value")
+        assert cache.load(file_name, key) == "value"
+        os.chmod(cache.file_name(file_name), 0o666)
+        assert cache.load(file_name, key) is None
+        shared = tempfile.mkdtemp()
+        os.chmod(shared, 0o777)
+        Chat(file_name, template_cache=TemplateCache(shared))
+        assert not os.listdir(shared)
+        private = path.join(tempfile.mkdtemp(), "cache")
+        Chat(file_name, template_cache=TemplateCache(private))
+        assert os.stat(private).st_mode & 0o777 == 0o700
+    return 'template_cache_tests pass'
+
+
+def render_tests():
+    chat = Chat(resources=None, template_cache=None)
+    response = "%1 says {% if %2 == 5 %}{% up %name %}{% else %}no{% endif %}{fruit:%3}"
+    plan = compile_plan(response, chat._condition(response))
+    assert [op[0] for op in plan] == [TEXT, IF, ACTION]
+    assert plan[0] == (TEXT, (1, " says "))
+    assert plan[1][2][0][0][:2] == (ACTION, "up") and plan[1][3] == ((TEXT, ("no",)),)
+    assert compile_plan("100\\% sure %10") == ((TEXT, ("100\\% sure ", 10)),)
+    session = mapper.Session(chat, "general")
+    match = re.match(r"(?P<name>\w+) (\w+) (\w+)", "alice 5 pears")
+    compiled = chat._Chat__compile_response(response)
+    for compiled_response in (compiled, compiled[:2]):
+        assert chat._wildcards(session, compiled_response, match, None) == "alice says ALICE pears"
+    assert session.memory["fruit"] == "pears"
+    session.attr["match"] = match
+    assert chat._check_and_evaluate_condition(session, response, [], 0, 7) == "alice says"
+
+    def matched(session, text):
+        parent_match = session.attr["pmatch"]
+        return "%s/%s" % (session.attr["match"].group(0), parent_match and parent_match.group(1))
+
+    # called functions read the client matches from the session attributes while the response renders
+    chat = Chat([(r"ask (\w+)", ["{% call matched: %1 %}"]), (r"why", r"(\w+) again", ["{% call matched: %1 %}"]),
+                 (r"say (.*)", ["%1 again"])], call=MultiFunctionCall({"matched": matched}), resources=None,
+                template_cache=None)
+    assert chat.say("ask me") == "ask me/None" and chat.say("say hi") == "hi again" and chat.say("why") == "why/hi"
+    assert chat._states["general"].attr["match"] is None
+    return 'render_tests pass'
+
+
+def async_tests():
+    async def slow_echo(session, text):
+        await asyncio.sleep(0.2)
+        return text.strip().upper()
+
+    def echo(session, text):
+        return text.strip().upper()
+
+    pairs = [(r"echo (.*)", ["{% call echo: %1 %}"]), (r"slow (.*)", ["{% call slow_echo: %1 %}"]),
+             (r"(.*)", ["{{!last:%1}}{% if %1 == again %}{% chat echo {last} %}{% else %}ok{% endif %}"])]
+    chat = Chat(pairs, call=MultiFunctionCall({"echo": echo, "slow_echo": slow_echo}),
+                resources=None, template_cache=None)
+    assert chat.say("echo hi") == asyncio.run(chat.asay("echo hi")) == "HI"
+    assert asyncio.run(chat.arespond("slow hi")) == "HI"
+    try:
+        chat.say("slow hi")
+        assert False, "coroutine function called from say"
+    except TypeError:
+        pass
+
+    async def converse():
+        return await asyncio.gather(*(chat.asay("slow %d" % i, session_id=str(i)) for i in range(100)))
+
+    for i in range(100):
+        chat.start_new_session(str(i))
+    start = time.perf_counter()
+    assert asyncio.run(converse()) == [str(i) for i in range(100)]
+    assert time.perf_counter() - start < 2
+    assert chat.say("again", session_id="1") == asyncio.run(chat.asay("again", session_id="2")) == "AGAIN"
+    return 'async_tests pass'
+
+
+MEMORY_TEMPLATE = TEMPLATE + """
+{% block %}
+    {% client %}remember (.*){% endclient %}
+    {% response %}{{!thing:%1}}{% if %1 == secret %}{% up ok %}{% else %}ok{% endif %}{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}recall{% endclient %}
+    {% response %}{thing}{% endresponse %}
+{% endblock %}
+"""
+
+
+def thread_tests():
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None)
+
+    def converse(i):
+        session_id = "user%d" % i
+        chat.start_new_session(session_id)
+        replies = []
+        for j in range(20):
+            replies.append(chat.say("remember thing%d %d" % (i, j), session_id=session_id))
+            replies.append(chat.say("recall", session_id=session_id))
+        replies.append(chat.say("teach word%d means %d" % (i, i), session_id=session_id))
+        return replies
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(converse, range(32)))
+    for i, replies in enumerate(results):
+        assert replies[:40] == [reply for j in range(20) for reply in ("ok", "thing%d %d" % (i, j))], replies
+        assert replies[40] == "learned word%d" % i
+    for i in range(32):
+        assert chat.say("what is word%d" % i) == "word%d is %d" % (i, i)
+    return 'thread_tests pass'
+
+
+def batch_tests():
+    chat = Chat(template_file(MEMORY_TEMPLATE), template_cache=None)
+    messages = [("user%d" % (i % 7), "remember %d" % i if i % 3 else "recall") for i in range(300)]
+    expected = []
+    memory = {}
+    for session_id, message in messages:
+        if message == "recall":
+            expected.append(memory.get(session_id, ""))
+        else:
+            memory[session_id] = message.split()[1]
+            expected.append("ok")
+    assert list(chat.say_many(iter(messages), processes=3, chunk_size=4)) == expected
+    assert list(chat.say_many([], processes=2)) == []
+    file_name = path.join(tempfile.mkdtemp(), "sessions.db")
+    backend = SQLiteBackend(file_name, interval=60)
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, backend=backend)
+    # the writer of the parent is running when the workers are forked
+    chat.say("remember parent", session_id="parent")
+    messages = [("user%d" % i, "remember thing%d" % i) for i in range(6)]
+    assert list(chat.say_many(messages, processes=2)) == ["ok"] * 6
+    backend.close()
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None,
+                backend=SQLiteBackend(file_name))
+    assert [chat.say("recall", session_id="user%d" % i) for i in range(6)] == ["thing%d" % i for i in range(6)]
+    assert chat.say("recall", session_id="parent") == "parent"
+    return 'batch_tests pass'
+
+
+def coalesce_tests():
+    calls = []
+
+    def lookup(session, text):
+        calls.append(text)
+        time.sleep(0.2)
+        return text.strip().upper()
+
+    async def alookup(session, text):
+        calls.append(text)
+        await asyncio.sleep(0.2)
+        return text.strip().upper()
+
+    pairs = [(r"look (.*)", ["{% call lookup: %1 %}"]), (r"alook (.*)", ["{% call alookup: %1 %}"]),
+             (r"echo (.*)", ["{% call echo: %1 %}"])]
+    chat = Chat(pairs, call=MultiFunctionCall({"lookup": lookup, "alookup": alookup, "echo": lookup},
+                                              coalesce={"lookup", "alookup"}),
+                resources=None, template_cache=None)
+    for i in range(20):
+        chat.start_new_session(str(i))
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        replies = list(executor.map(lambda i: chat.say("look %s" % ("up" if i % 2 else "down"), session_id=str(i)),
+                                    range(20)))
+    assert replies == ["UP" if i % 2 else "DOWN" for i in range(20)]
+    assert sorted(calls) == [" down ", " up "]
+    del calls[:]
+
+    async def converse(message):
+        return await asyncio.gather(*(chat.asay(message, session_id=str(i)) for i in range(20)))
+
+    assert asyncio.run(converse("alook up")) == ["UP"] * 20
+    assert calls == [" up "]
+    del calls[:]
+    assert asyncio.run(converse("echo up")) == ["UP"] * 20
+    assert len(calls) == 20
+    del calls[:]
+
+    async def cancel_leader():
+        flight = SingleFlight()
+        leader = asyncio.ensure_future(flight.ado("up", alookup, None, "up"))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.ensure_future(flight.ado("up", alookup, None, "up"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        # the waiter runs the call again instead of being cancelled with the leader
+        assert await waiter == "UP"
+        assert leader.cancelled()
+        return flight.shared
+
+    assert asyncio.run(cancel_leader()) == 0
+    assert calls == ["up", "up"]
+    return 'coalesce_tests pass'
+
+
+def parallel_tests():
+    def lookup(session, text):
+        time.sleep(0.2)
+        return text.strip().upper()
+
+    async def alookup(session, text):
+        await asyncio.sleep(0.2)
+        return text.strip().upper()
+
+    def remember(session, text):
+        session.memory["last"] = text.strip()
+        return text.strip()
+
+    call = MultiFunctionCall({"lookup": lookup, "alookup": alookup, "remember": remember},
+                             coalesce={"lookup", "alookup"})
+    pairs = [(r"both (\w+) (\w+)", ["{% call lookup: %1 %} and {% call lookup: %2 %}!"]),
+             (r"async (\w+) (\w+)", ["{% call alookup: %1 %} and {% call alookup: %2 %}"]),
+             (r"city (\w+)", ["{!city:%1}{% call lookup: {city} %}, {% call lookup: {city} %} "
+                              "{!city:rome}{% call lookup: {city} %}"]),
+             (r"ordered (\w+)", ["{% call remember: %1 %}/{% call lookup: {last} %}"])]
+    serial = Chat(pairs, call=call, resources=None, template_cache=None)
+    parallel = Chat(pairs, call=call, resources=None, template_cache=None, parallel_calls=4)
+    for message in ("both up down", "city paris", "ordered first", "ordered second"):
+        assert serial.say(message) == parallel.say(message), message
+    assert parallel.say("city oslo") == "OSLO, OSLO ROME"
+    start = time.perf_counter()
+    assert parallel.say("both up down") == "UP and DOWN!"
+    assert time.perf_counter() - start < 0.35
+    start = time.perf_counter()
+    assert asyncio.run(parallel.asay("async up down")) == "UP and DOWN"
+    assert time.perf_counter() - start < 0.35
+    try:
+        Chat(pairs, resources=None, template_cache=None, parallel_calls=-1)
+        assert False, "negative parallel_calls accepted"
+    except ValueError:
+        pass
+    return 'parallel_tests pass'
+
+
+def eviction_tests():
+    saved = {}
+
+    def save(session):
+        saved[session.session_id] = dict(session.memory)
+
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, max_sessions=3, on_evict=save)
+    for i in range(5):
+        assert chat.say("remember %d" % i, session_id="user%d" % i) == "ok"
+    assert chat.say("recall", session_id="user2") == "2"
+    assert chat.say("recall", session_id="user5") == ""
+    assert sorted(saved) == ["user0", "user1", "user3"] and saved["user0"] == {"thing": "0"}
+    assert len(chat._states) == 4 and "user0" not in chat._states and "user2" in chat._states
+    # a new message starts an evicted session afresh
+    assert chat.say("recall", session_id="user0") == ""
+    assert len(chat._session_locks) == 0
+
+    def fail(session):
+        if session.session_id == "user0":
+            raise IOError("store unavailable")
+        save(session)
+
+    saved.clear()
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, max_sessions=1, on_evict=fail)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logging.getLogger("chatbot").addHandler(handler)
+    try:
+        # the reply of another session doesn't fail, the session is kept
+        for i in range(3):
+            assert chat.say("remember %d" % i, session_id="user%d" % i) == "ok"
+    finally:
+        logging.getLogger("chatbot").removeHandler(handler)
+    assert "user0" in chat._states and "user1" not in chat._states and saved == {"user1": {"thing": "1"}}
+    assert len(records) == 2 and "user0" in records[0].getMessage()
+    assert chat.say("recall", session_id="user0") == "0"
+
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, session_ttl=0.1)
+    chat.say("remember old", session_id="old")
+    time.sleep(0.2)
+    chat.say("remember new", session_id="new")
+    assert "old" not in chat._states and chat.say("recall", session_id="new") == "new"
+    time.sleep(0.2)
+    chat.evict_sessions()
+    assert "new" not in chat._states
+    return 'eviction_tests pass'
+
+
+def backend_tests():
+    file_name = path.join(tempfile.mkdtemp(), "sessions.db")
+    backend = SQLiteBackend(file_name, interval=60)
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, backend=backend,
+                max_sessions=1)
+    assert chat.say("remember apples", session_id="alice") == "ok"
+    assert chat.say("remember pears", session_id="bob") == "ok"
+    assert "alice" not in chat._states
+    # nothing written yet, evicted sessions come back from the pending states
+    assert backend._dirty and chat.say("recall", session_id="alice") == "apples"
+    backend.close()
+
+    backend = SQLiteBackend(file_name)
+    chat = Chat(template_file(MEMORY_TEMPLATE), resources=None, template_cache=None, backend=backend)
+    assert chat.say("recall", session_id="bob") == "pears"
+    session = mapper.Session(chat, "alice")
+    chat.say("What is your name", session_id="alice")
+    assert session.memory == {"thing": "apples"} and session.conversation.get_user_message(0) == "remember apples"
+    assert session.conversation.get_bot_message(-1) == "I am a test bot" and len(session.conversation) == 6
+    chat.start_new_session("alice")
+    backend.flush()
+    assert SQLiteBackend(file_name).load("alice")["memory"] == {}
+
+    class LoadOnly(SessionBackend):
+        def load(self, session_id):
+            return None
+
+    try:
+        LoadOnly()
+        assert False, "backend without save accepted"
+    except TypeError:
+        pass
+    return 'backend_tests pass'
+
+
+def conversation_tests():
+    conversation = mapper.Conversation(depth=4)
+    for i in range(5):
+        conversation.append_user_message("user %d" % i)
+        conversation.append_bot_message("bot %d" % i)
+    assert list(conversation) == ["user 3", "bot 3", "user 4", "bot 4"] and len(conversation) == 4
+    assert conversation[0] == "user 3" and conversation[-1] == "bot 4" and conversation[1:3] == ["bot 3", "user 4"]
+    assert conversation.get_bot_message(-1) == "bot 4" and conversation.get_user_message(0) == "user 3"
+    assert conversation.get_bot_message(-2) == "bot 3"
+    for get, index in ((conversation.get_bot_message, -3), (conversation.get_user_message, 2),
+                       (conversation.__getitem__, 4)):
+        try:
+            get(index)
+            assert False, "index out of range accepted"
+        except IndexError:
+            pass
+    copy = mapper.Conversation(conversation, depth=2)
+    assert list(copy) == ["user 4", "bot 4"]
+    assert list(mapper.Conversation.from_state(conversation.state(), depth=3)) == ["bot 3", "user 4", "bot 4"]
+
+    chat = Chat(template_file(), resources=None, template_cache=None)
+    for _ in range(150):
+        chat.say("What is your name")
+    assert len(mapper.Session(chat, "general").conversation) == 300
+    chat = Chat(template_file(), resources=None, template_cache=None, conversation_depth=3)
+    for _ in range(10):
+        chat.say("What is your name")
+    session = mapper.Session(chat, "general")
+    assert len(session.conversation) == 3 and session.conversation.get_bot_message(-1) == "I am a test bot"
+    assert len(session.conversation._messages) == 3
+    session.conversation = ["hi", "hello", "bye", "see you"]
+    assert session.conversation.state() == [["bot", "hello"], ["user", "bye"], ["bot", "see you"]]
+    assert session.conversation.get_bot_message(-1) == "see you" and session.conversation.get_user_message(0) == "bye"
+    session.conversation = [["user", "one"], ("bot", "two")]
+    assert session.conversation.state() == [["user", "one"], ["bot", "two"]]
+    session.conversation = mapper.Conversation.from_state([["bot", "welcome"]])
+    assert session.conversation.state() == [["bot", "welcome"]] and session.conversation.depth == 3
+    session.conversation = []
+    assert len(session.conversation) == 0
+    try:
+        session.conversation = [("robot", "beep")]
+        assert False, "unknown role accepted"
+    except ValueError:
+        pass
+    return 'conversation_tests pass'
+
+
+HISTORY_TEMPLATE = """
+{% block %}
+    {% client %}i like (\\w+){% endclient %}
+    {% response %}why?{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}because{% endclient %}
+    {% prev user 2 %}i like (\\w+){% endprev %}
+    {% response %}so you like %!1{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}and then{% endclient %}
+    {% prev bot 4 %}why\\?{% endprev %}
+    {% response %}then nothing{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}remind (\\w+){% endclient %}
+    {% response %}noted{% endresponse %}
+    {% learn %}
+        {% block %}
+            {% client %}what was it{% endclient %}
+            {% prev user 2 %}remind %1{% endprev %}
+            {% response %}%1{% endresponse %}
+        {% endblock %}
+    {% endlearn %}
+{% endblock %}
+{% block %}
+    {% client %}(.*){% endclient %}
+    {% response %}go on{% endresponse %}
+{% endblock %}
+"""
+
+
+def history_tests():
+    chat = Chat(template_file(HISTORY_TEMPLATE), resources=None, template_cache=None)
+    replies = [chat.say(message) for message in ("I like tea", "because", "because", "because", "and then",
+                                                 "and then", "and then")]
+    assert replies == ["why?", "so you like tea", "so you like tea", "go on", "then nothing", "go on",
+                       "go on"], replies
+    conversation = mapper.Session(chat, "general").conversation
+    assert conversation.get_user_message(0, normalized=True) == "I like tea"
+    assert list(conversation.previous(False, 2, skip=1)) == ["and then", "and then"]
+    try:
+        Chat(template_file(HISTORY_TEMPLATE.replace("prev user 2", "prev someone")), resources=None,
+             template_cache=None)
+        assert False, "invalid prev argument accepted"
+    except SyntaxError:
+        pass
+    # prev tags with a depth in learned blocks
+    replies = [chat.say(message) for message in ("remind milk", "hmm", "what was it", "what was it")]
+    assert replies == ["noted", "go on", "milk", "go on"], replies
+    file_name = template_file()
+    chat.save_template(file_name)
+    chat = Chat(file_name, resources=None, template_cache=None)
+    assert [chat.say(message) for message in ("I like coffee", "because")] == ["why?", "so you like coffee"]
+    return 'history_tests pass'
+
+
+LEARN_ORDER_TEMPLATE = """
+{% block %}
+    {% client %}teach{% endclient %}
+    {% response %}taught{% endresponse %}
+    {% learn %}
+        {% block %}
+            {% client %}hello (.*){% endclient %}
+            {% response %}first{% endresponse %}
+        {% endblock %}
+        {% block %}
+            {% client %}hello there{% endclient %}
+            {% response %}second{% endresponse %}
+        {% endblock %}
+    {% endlearn %}
+{% endblock %}
+{% block %}
+    {% client %}relearn{% endclient %}
+    {% response %}taught{% endresponse %}
+    {% learn %}
+        {% block %}
+            {% client %}hello (\\w+){% endclient %}
+            {% response %}again{% endresponse %}
+        {% endblock %}
+    {% endlearn %}
+{% endblock %}
+"""
+
+
+def learned_tests():
+    chat = Chat(template_file(), resources=None, template_cache=None, learn_scope="session", max_learned=3)
+    blocks = len(chat._pairs['']['pairs'])
+    chat.start_new_session("alice")
+    chat.start_new_session("bob")
+    assert chat.say("teach foo means bar", session_id="alice") == "learned foo"
+    assert chat.say("what is foo", session_id="alice") == "foo is bar"
+    assert chat.say("what is foo", session_id="bob") != "foo is bar"
+    for _ in range(5):
+        chat.say("teach foo means baz", session_id="alice")
+    assert chat.say("what is foo", session_id="alice") == "foo is baz"
+    assert len(chat._states["alice"].learned) == 1
+    for word in ("one", "two", "three"):
+        chat.say("teach %s means %s" % (word, word), session_id="alice")
+    assert len(chat._states["alice"].learned) == 3
+    assert chat.say("what is foo", session_id="alice") != "foo is baz"
+    assert chat.say("what is three", session_id="alice") == "three is three"
+    assert len(chat._pairs['']['pairs']) == blocks and chat._states["bob"].learned is None
+    chat = Chat(template_file(), resources=None, template_cache=None, max_learned=2)
+    for i in range(10):
+        chat.say("teach word%d means %d" % (i, i), session_id="user%d" % i)
+    assert chat.say("what is word9") == "word9 is 9" and chat.say("what is word0") != "word0 is 0"
+    assert len(chat._learned) == 2 and len(chat._pairs['']['pairs']) == blocks
+    matcher = chat._learned.matcher('')
+    chat.say("teach word10 means 10")
+    # learned blocks are added to the matcher built before, not analysed again
+    assert chat._learned.matcher('') is not matcher and len(matcher) == 2
+    assert chat.say("what is word10") == "word10 is 10" and chat.say("what is word9") == "word9 is 9"
+    chat.say("teach word11 means 11")
+    assert chat.say("what is word11") == "word11 is 11" and chat.say("what is word9") != "word9 is 9"
+    file_name = path.join(tempfile.mkdtemp(), "saved.template")
+    chat.save_template(file_name)
+    saved = Chat(file_name, resources=None, template_cache=None)
+    assert saved.say("what is word11") == "word11 is 11" and saved.say("what is word10") == "word10 is 10"
+    assert saved.say("What is your name") == "I am a test bot"
+    ordered = Chat(template_file(LEARN_ORDER_TEMPLATE), resources=None, template_cache=None)
+    ordered.say("teach")
+    # blocks of one learn tag keep their order, first match wins
+    assert ordered.say("hello there") == "first"
+    ordered.say("teach")
+    assert ordered.say("hello there") == "first"
+    ordered.say("relearn")
+    assert ordered.say("hello there") == "again"
+    try:
+        Chat(template_file(), resources=None, template_cache=None, learn_scope="user")
+        assert False, "invalid learn_scope accepted"
+    except ValueError:
+        pass
+    return 'learned_tests pass'
+
+
+METRICS_TEMPLATE = """
+{% block %}
+    {% client %}slow (.*){% endclient %}
+    {% response %}{% if %1 > 0 %}{% call wait: %1 %}{% endif %}{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}shop{% endclient %}
+    {% response %}{% topic shop %}shopping{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}(.*){% endclient %}
+    {% response %}anything{% endresponse %}
+{% endblock %}
+{% group shop %}
+    {% block %}
+        {% client %}buy (.*){% endclient %}
+        {% response %}bought %1{% endresponse %}
+    {% endblock %}
+{% endgroup %}
+"""
+
+
+def metrics_tests():
+    def wait(session, text):
+        time.sleep(float(text))
+        return "done"
+
+    reports = []
+    chat = Chat(template_file(METRICS_TEMPLATE), call=MultiFunctionCall({"wait": wait}), resources=None,
+                template_cache=None, on_message=reports.append, slow_message_threshold=0.1)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logging.getLogger("chatbot").addHandler(handler)
+    try:
+        assert chat.say("slow 0.2") == "done"
+        replies = [chat.say(message) for message in ("shop", "buy milk", "hello")]
+        assert replies == ["shopping", "bought milk", "anything"], replies
+    finally:
+        logging.getLogger("chatbot").removeHandler(handler)
+    assert [metrics.message for metrics in reports] == ["slow 0.2", "shop", "buy milk", "hello"]
+    slow = reports[0]
+    assert slow.duration >= slow.stages["call"] >= 0.2 > slow.stages["condition"] > 0
+    assert slow.counts["normalize"] == slow.counts["condition"] == slow.counts["call"] == 1
+    assert [detail[:2] for detail in slow.details] == [("call", "wait")]
+    assert slow.patterns_tried >= 1 and slow.topic_depth == 0 and "spell_checker" in slow.caches
+    assert [metrics.topic_depth for metrics in reports[2:]] == [0, 1]
+    assert len(records) == 1 and "slow 0.2" in records[0].getMessage()
+    eager = Chat(template_file(METRICS_TEMPLATE), resources=None, template_cache=None, spell_correction="eager",
+                 on_message=reports.append)
+    eager.spell_checker = SpellChecker(tempfile.mkdtemp())
+    for _ in range(3):
+        eager.say("hello")
+    # the lookups of every reply, not the totals since the Chat was created
+    assert [(metrics.caches["spell_checker"].hits, metrics.caches["spell_checker"].misses)
+            for metrics in reports[-3:]] == [(0, 1), (1, 0), (1, 0)]
+    quiet = Chat(template_file(METRICS_TEMPLATE), resources=None, template_cache=None)
+    session = mapper.Session(quiet, "general")
+    assert quiet._respond(session, "hello") == "anything" and session.metrics is None
+    return 'metrics_tests pass'
+
+
+SPELLING_TEMPLATE = """
+{% block %}
+    {% client %}go (\\w+){% endclient %}
+    {% response %}{% topic %1 %}going{% endresponse %}
+{% endblock %}
+{% block %}
+    {% client %}(.*){% endclient %}
+    {% response %}root catch %1{% endresponse %}
+{% endblock %}
+{% group shop %}
+    {% block %}
+        {% client %}purchase (.*){% endclient %}
+        {% response %}bought %1{% endresponse %}
+    {% endblock %}
+    {% response %}shop default{% endresponse %}
+{% endgroup %}
+{% group quiet %}
+    {% block %}
+        {% client %}purchase (.*){% endclient %}
+        {% response %}quietly bought %1{% endresponse %}
+    {% endblock %}
+{% endgroup %}
+"""
+
+
+def spell_correction_tests():
+    local_path = tempfile.mkdtemp()
+    os.mkdir(path.join(local_path, "en"))
+    with open(path.join(local_path, "en", "words.txt"), "w", encoding="utf-8") as words:
+        words.write("purchase milk hello shop quiet\n")
+    spell_checker = SpellChecker(local_path, precompiled=False)
+    expected = {
+        # the defaults of the current topic come before its parents, whatever the policy
+        "never": ["root catch hello", "shop default", "shop default", "root catch purchse milk",
+                  "root catch purchse milk"],
+        "eager": ["root catch hello", "shop default", "bought milk", "quietly bought milk",
+                  "root catch purchse milk"],
+        # the corrected message is only tried once the raw one missed up to the shop defaults
+        "fallback": ["root catch hello", "shop default", "bought milk", "root catch purchse milk",
+                     "root catch purchse milk"],
+    }
+    for policy, replies in expected.items():
+        chat = Chat(template_file(SPELLING_TEMPLATE), resources=None, template_cache=None, spell_correction=policy)
+        chat.spell_checker = spell_checker
+        chat.say("go shop", session_id="shop")
+        chat.say("go quiet", session_id="quiet")
+        got = [chat.say("hello"), chat.say("hello", session_id="shop"), chat.say("purchse milk", session_id="shop"),
+               chat.say("purchse milk", session_id="quiet"), chat.say("purchse milk")]
+        assert got == replies, (policy, got)
+    return 'spell_correction_tests pass'
+
+
+if __name__ == '__main__':
+    print(resources_tests())
+    print(template_cache_tests())
+    print(render_tests())
+    print(async_tests())
+    print(thread_tests())
+    print(batch_tests())
+    print(coalesce_tests())
+    print(parallel_tests())
+    print(eviction_tests())
+    print(backend_tests())
+    print(conversation_tests())
+    print(history_tests())
+    print(learned_tests())
+    print(metrics_tests())
+    print(spell_correction_tests())
@@ -0,0 +1,62 @@
+import re
+from chatbot.matcher import IntentMatcher, required_literals
+
+
+def compile_block(clients, parents=None, response="ok"):
+    return ([re.compile(i, re.IGNORECASE) for i in clients],
+            parents and [re.compile(i, re.IGNORECASE) for i in parents],
+            ((response, []),), {})
+
+
+def linear_match(blocks, text, previous_text):
+    for (patterns, parents, response, learn) in blocks:
+        for pattern in patterns:
+            match = pattern.match(text)
+            if match:
+                break
+        else:
+            continue
+        if parents is None:
+            return match, None, response, learn
+        for parent in parents:
+            parent_match = parent.match(previous_text)
+            if parent_match:
+                return match, parent_match, response, learn
+
+
+def unit_tests():
+    assert required_literals(re.compile(r"What is (.*)", re.I)) == ("what is ", ())
+    assert required_literals(re.compile(r"(I am |my name is )?(.*) ok", re.I)) == ("", (" ok",))
+    assert required_literals(re.compile(r"^Why (do|can) not you (.*)", re.I)) == ("why ", (" not you ",))
+    assert required_literals(re.compile(r"(?:bye)+ now", re.I)) == ("", (" now", "bye"))
+    assert required_literals(re.compile(r"café au lait", re.I)) == ("caf", (" au lait",))
+
+    blocks = [
+        compile_block(["Hello (.*)", "Hi (.*)"], response="greet"),
+        compile_block(["(.*) please"], response="polite"),
+        compile_block(["yes"], parents=["(.*)do you like (.*)"], response="liked"),
+        compile_block(["yes", "sure"], response="agree"),
+        compile_block(["(.*)"], response="fallback"),
+    ]
+    matcher = IntentMatcher(blocks[2:])
+    matcher.prepend(blocks[:2])
+    assert len(matcher) == 7
+    for text, previous_text in [("hello there", ""), ("HI bob", ""), ("help please", ""),
+                                ("yes", "do you like tea?"), ("yes", "how are you"), ("sure", ""),
+                                ("hello please", ""), ("", ""), ("K please", "")]:
+        expected = linear_match(blocks, text, previous_text)
+        got = matcher.match(text, previous_text)
+        assert got[2:] == expected[2:], (text, got, expected)
+        assert got[0].re is expected[0].re and got[0].span() == expected[0].span()
+    assert matcher.match("yes", "do you like tea?")[2] == (("liked", []),)
+    merged = IntentMatcher(blocks[3:])
+    merged.prepend_matcher(IntentMatcher(blocks[:3]))
+    for text, previous_text in [("hello there", ""), ("help please", ""), ("yes", "do you like tea?"),
+                                ("yes", "no"), ("hmm", "")]:
+        assert merged.match(text, previous_text)[2] == linear_match(blocks, text, previous_text)[2]
+    assert IntentMatcher().match("anything", "") is None
+    return 'unit_tests pass'
+
+
+if __name__ == '__main__':
+    print(unit_tests())
@@ -1,7 +1,8 @@
 import chatbot
-from os import path
+import tempfile
+from os import path, mkdir
 from collections import Counter
-from chatbot.spellcheck import SpellChecker
+from chatbot.spellcheck import SpellChecker, compile_words
 
 
 def unit_tests():
@@ -39,12 +40,77 @@ def unit_tests():
     return 'unit_tests pass'
 
 
+def corpus(words):
+    """
+    Local path with an english words.txt where each word is more frequent than the previous one.
+    """
+    local_path = tempfile.mkdtemp()
+    mkdir(path.join(local_path, 'en'))
+    with open(path.join(local_path, 'en', 'words.txt'), 'w', encoding='utf-8') as words_file:
+        for count, word in enumerate(words, 1):
+            words_file.write((word + ' ') * count + '\n')
+    return local_path
+
+
+def engine_tests(tests):
+    """
+    The symspell engine must give the same corrections as the default engine.
+    """
+    words = {'spelling', 'corrected', 'bicycle', 'inconvenient', 'arranged', 'poetry', 'word'}
+    local_path = corpus(sorted({right for right, _ in tests} | words))
+    norvig = SpellChecker(local_path, language='en')
+    symspell = SpellChecker(local_path, language='en', engine='symspell')
+    # the index is built on the first correction
+    assert symspell._index is None
+    for word in ['speling', 'korrectud', 'bycycle', 'inconvient', 'arrainged', 'peotry', 'peotryy', 'word',
+                 'quintessential'] + [wrong for _, wrong in tests]:
+        assert norvig.correction(word) == symspell.correction(word), word
+    assert symspell._index is not None
+    symspell.words_changed()
+    assert symspell._index is None and symspell.correction('peotry') == 'poetry'
+    return 'engine_tests pass'
+
+
+def cache_tests():
+    spell_checker = SpellChecker(corpus(['spelling', 'poetry']), language='en', cache_size=2)
+    assert spell_checker.correction('speling peotry speling') == 'spelling poetry spelling'
+    info = spell_checker.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+    assert spell_checker.correction('poetri') == 'poetry'
+    assert spell_checker.cache_info().currsize == 2
+    spell_checker.WORDS['poetri'] = 10
+    spell_checker.words_changed()
+    assert spell_checker.cache_info().currsize == 0
+    assert spell_checker.correction('poetrii') == 'poetri'
+    spell_checker.WORDS = Counter()
+    assert spell_checker.correction('poetrii') == 'poetrii'
+    return 'cache_tests pass'
+
+
+def store_tests():
+    local_path = corpus(['spelling', 'poetry', 'word', 'café'])
+    text_checker = SpellChecker(local_path, language='en', precompiled=False)
+    compile_words(local_path, language='en')
+    spell_checker = SpellChecker(local_path, language='en')
+    assert type(spell_checker.WORDS).__name__ == 'WordStore'
+    assert len(spell_checker.WORDS) == len(text_checker.WORDS) == 4
+    assert spell_checker.total_word_count == text_checker.total_word_count == 10
+    assert dict(spell_checker.WORDS.items()) == dict(text_checker.WORDS)
+    assert spell_checker.WORDS.most_common(2) == [('café', 4), ('word', 3)]
+    assert spell_checker.WORDS['poetry'] == 2
+    assert spell_checker.WORDS['quintessential'] == 0 and 'quintessential' not in spell_checker.WORDS
+    assert spell_checker.probability('café') == 0.4
+    for word in ['speling', 'peotryy', 'wordd', 'cafe', 'quintessential']:
+        assert spell_checker.correction(word) == text_checker.correction(word)
+    return 'store_tests pass'
+
+
 def spell_test(tests, verbose=False):
     """
     Run correction(wrong) on all (right, wrong) pairs; report results.
     """
     import time
-    start = time.clock()
+    start = time.perf_counter()
     good, unknown = 0, 0
     n = len(tests)
     local_path = path.join(path.dirname(path.abspath(chatbot.__file__)), "local")
@@ -57,7 +123,7 @@ def spell_test(tests, verbose=False):
             if verbose:
                 print('correction({}) => {} ({}); expected {} ({})'
                       .format(wrong, w, spell_checker.WORDS[w], right, spell_checker.WORDS[right]))
-    dt = time.clock() - start
+    dt = time.perf_counter() - start
     print('{:.0%} of {} correct ({:.0%} unknown) at {:.0f} words per second '
           .format(good / n, n, unknown / n, n / dt))
 
@@ -75,5 +141,8 @@ def test_set(lines):
 
 if __name__ == '__main__':
     print(unit_tests())
+    print(cache_tests())
+    print(store_tests())
+    print(engine_tests(test_set(open(path.join(path.dirname(path.abspath(__file__)), 'spell-testset1.txt')))[:60]))
     spell_test(test_set(open(path.join(path.dirname(path.abspath(__file__)), 'spell-testset1.txt'))))
     spell_test(test_set(open(path.join(path.dirname(path.abspath(__file__)), 'spell-testset2.txt'))))
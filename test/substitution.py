@@ -0,0 +1,27 @@
+import re
+from chatbot.substitution import TokenTrie
+
+TABLE = {"i": "you", "i am": "you are", "i'm": "you are", "my": "your", "you": "me", "uh-huh": "yes",
+         "etc.": "and so on", ":)": "smile", "'s": " is", "_x": "x"}
+
+
+def regex_substitute(table, text):
+    keys = sorted(table, key=len, reverse=True)
+    regex = re.compile(r"\b({0})\b".format("|".join(map(re.escape, keys))), re.IGNORECASE)
+    return regex.sub(lambda mo: table[mo.group(0).lower()], text)
+
+
+def unit_tests():
+    trie = TokenTrie(TABLE)
+    for text in ["I am here", "i  am", "I'm my own", "Uh-huh, you", "items, iam, mine", "bob's etc. etc.x",
+                 "oh :) :)x x:)", "a_x _x _xy", "I", "", "Ä i"]:
+        assert trie.sub(text) == regex_substitute(TABLE, text), (text, trie.sub(text))
+    assert trie.sub("nothing to change") == "nothing to change"
+    # lower() makes two characters of İ, the regex lookup of such a match fails
+    assert trie.sub("İ am i") == "İ am you"
+    assert TokenTrie({"Hello": "hi"}).sub("HELLO there") == "hi there"
+    return 'unit_tests pass'
+
+
+if __name__ == '__main__':
+    print(unit_tests())